@@ -2,10 +2,68 @@
 import torch
 from torch.functional import Tensor
 import torch.nn as nn
-from functools import partial
+import torch.nn.functional as F
+from torch.ao.nn.quantized import FloatFunctional
+from torch.utils.checkpoint import checkpoint
+from functools import lru_cache, partial
+import contextlib
 import math
+import threading
 import warnings
 
+_HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
+# the scale argument of scaled_dot_product_attention came with torch 2.1
+_SDPA_SCALE = _HAS_SDPA and torch.__version__ >= '2.1'
+_recompute = threading.local()
+
+
+def recomputing():
+    """ True while checkpointed modules run their forward again in backward, see set_checkpointing """
+    return getattr(_recompute, 'active', False)
+
+
+@contextlib.contextmanager
+def _recompute_context():
+    # the recompute runs in the thread doing the backward, where it is read
+    _recompute.active = True
+    try:
+        yield
+    finally:
+        _recompute.active = False
+
+
+class FP32LayerNorm(nn.LayerNorm):
+    """ LayerNorm computed in float32 under autocast, returned in the dtype of its input """
+
+    def forward(self, x):
+        with torch.autocast(x.device.type, enabled=False):
+            return super().forward(x.float()).to(x.dtype)
+
+
+def workspace_linear(x, weight, bias, workspace, name):
+    """ F.linear(x, weight, bias) as one matmul over the flattened tokens, written into the
+    workspace buffer name. out= matmuls are not autocast, so under autocast or for inputs
+    of another dtype than weight, or without a workspace, this is a plain F.linear.
+    """
+    if workspace is None or torch.is_autocast_enabled(x.device.type) or x.dtype != weight.dtype:
+        return F.linear(x, weight, bias)
+    out = workspace.get(name, x.shape[:-1] + weight.shape[:1], x.dtype, x.device)
+    x2d, out2d = x.reshape(-1, x.shape[-1]), out.view(-1, weight.shape[0])
+    if bias is None:
+        torch.mm(x2d, weight.t(), out=out2d)
+    else:
+        torch.addmm(bias, x2d, weight.t(), out=out2d)
+    return out
+
+
+def apply_linear(module, x, workspace=None, name=None):
+    """ module(x), through workspace_linear for a plain nn.Linear when a workspace is given.
+    Other modules, e.g. int8 ones from quantize.py, and hooked ones are called.
+    """
+    if workspace is None or type(module) is not nn.Linear or module._forward_hooks or module._forward_pre_hooks:
+        return module(x)
+    return workspace_linear(x, module.weight, module.bias, workspace, name)
+
 
 class Ffn(nn.Module):
     # feed forward network layer after attention
@@ -18,15 +76,76 @@ class Ffn(nn.Module):
         self.fc2 = nn.Linear(hidden_features, out_features)
         self.drop = nn.Dropout(drop)
 
-    def forward(self, x):
-        x = self.fc1(x)
+    def forward(self, x, workspace=None):
+        x = apply_linear(self.fc1, x, workspace, 'hidden')
         x = self.act(x)
         x = self.drop(x)
-        x = self.fc2(x)
+        x = apply_linear(self.fc2, x, workspace, 'fc2')
         x = self.drop(x)
         return x
 
 
+@lru_cache(maxsize=32)
+def window_index(grid, window, shift, device):
+    """ Token of a grid=(nh, nw) token grid at every position of its windows, and the
+    position of every token among them. The grid is padded to whole windows, then cyclically
+    shifted by shift tokens towards the top left. Grid and windows are enumerated column by
+    column, the PatchEmbed order. Padding points at token 0, window_mask hides it.
+    """
+    nh, nw = grid
+    ph, pw = -nh % window, -nw % window
+    index = F.pad(torch.arange(nw * nh).reshape(nw, nh), (0, ph, 0, pw))
+    padding = F.pad(torch.zeros(nw, nh, dtype=torch.bool), (0, ph, 0, pw), value=True)
+    if shift:
+        index = torch.roll(index, (-shift, -shift), dims=(0, 1))
+        padding = torch.roll(padding, (-shift, -shift), dims=(0, 1))
+    index, padding = [t.reshape((nw + pw) // window, window, (nh + ph) // window, window)
+                      .permute(0, 2, 1, 3).reshape(-1) for t in (index, padding)]
+    inverse = torch.empty(nw * nh, dtype=torch.long)
+    inverse[index[~padding]] = torch.arange(index.numel())[~padding]
+    return index.to(device), inverse.to(device)
+
+
+def window_partition(x, grid, window, shift=0):
+    """ (N, nw * nh, D) tokens of a grid=(nh, nw) token grid to (N, windows, window * window, D),
+    in one gather, see window_index
+    """
+    index, _ = window_index(tuple(grid), window, shift, x.device)
+    return x.index_select(1, index).reshape(x.shape[0], -1, window * window, x.shape[-1])
+
+
+def window_reverse(x, grid, window, shift=0):
+    """ Inverse of window_partition, (N, windows, window * window, D) to (N, nw * nh, D) """
+    _, inverse = window_index(tuple(grid), window, shift, x.device)
+    return x.reshape(x.shape[0], -1, x.shape[-1]).index_select(1, inverse)
+
+
+@lru_cache(maxsize=32)
+def window_mask(grid, window, shift, device):
+    """ (windows, 1, window * window, window * window) boolean mask, True where a token may
+    attend to another one of its window: both come from the same region of the grid, not
+    across the wrap around of the cyclic shift, and padding only attends to padding.
+    None when there is nothing to mask.
+    """
+    nh, nw = grid
+    ph, pw = -nh % window, -nw % window
+    if not (shift or ph or pw):
+        return None
+    labels = torch.zeros(nw + pw, nh + ph, dtype=torch.long)
+    if shift:
+        regions = (slice(0, -window), slice(-window, -shift), slice(-shift, None))
+        for i, cols in enumerate(regions):
+            for j, rows in enumerate(regions):
+                labels[cols, rows] = 3 * i + j
+    padding = torch.zeros(nw + pw, nh + ph, dtype=torch.bool)
+    padding[nw:] = True
+    padding[:, nh:] = True
+    labels[torch.roll(padding, (-shift, -shift), dims=(0, 1))] = -1
+    labels = labels.reshape((nw + pw) // window, window, (nh + ph) // window, window).permute(0, 2, 1, 3)
+    labels = labels.reshape(-1, window * window)
+    return (labels[:, :, None] == labels[:, None, :])[:, None].to(device)
+
+
 class Attention(nn.Module):
     def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
         super().__init__()
@@ -35,30 +154,156 @@ class Attention(nn.Module):
         # NOTE scale factor was wrong in my original version, can set manually to be compat with prev weights
         self.scale = qk_scale or head_dim ** -0.5
 
-        self.query = nn.Linear(dim, dim, bias=qkv_bias)
-        self.key = nn.Linear(dim, dim, bias=qkv_bias)
-        self.value = nn.Linear(dim, dim, bias=qkv_bias)
+        # query, key and value projections packed as one (3 * dim, dim) linear,
+        # checkpoints with separate query/key/value weights are packed on load
+        self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
+        # window attention in window x window token windows, shifted by shift tokens,
+        # when forward is given a token grid larger than the window; 0 is global attention
+        self.window = 0
+        self.shift = 0
+        # at inference, add the projected embeddings as per token biases, see fold
+        self.fold_embeddings = False
+        self.folded = {}
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for name in ('weight', 'bias'):
+            keys = [prefix + m + '.' + name for m in ('query', 'key', 'value')]
+            if all(key in state_dict for key in keys):
+                state_dict[prefix + 'qkv.' + name] = torch.cat([state_dict.pop(key) for key in keys])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project(self, q, k, v, workspace=None):
+        """ query/key/value projections, sharing one matmul between inputs that are the same tensor """
+        if not isinstance(self.qkv, nn.Linear):
+            # projections swapped for separate modules, e.g. int8 ones by quantize.py
+            return self.qkv(q, k, v)
+        D = q.shape[-1]
+        weight, bias = self.qkv.weight, self.qkv.bias
+
+        def linear(x, start, end, name):
+            return workspace_linear(x, weight[start:end], None if bias is None else bias[start:end], workspace, name)
+
+        if q is k and k is v:
+            return linear(q, 0, 3 * D, 'qkv').chunk(3, dim=-1)
+        if q is k:
+            q, k = linear(q, 0, 2 * D, 'qk').chunk(2, dim=-1)
+        else:
+            q, k = linear(q, 0, D, 'q'), linear(k, D, 2 * D, 'k')
+        return q, k, linear(v, 2 * D, 3 * D, 'v')
+
+    def fold(self, name, spans, dtype):
+        """ dtype bias of the query/key/value rows [start, end) of qkv for the (embed, start, end)
+        spans, with embed projected into it: qkv(x + embed) = qkv(x) + fold(...) for the
+        linear qkv. embed None gets the plain bias. Cached under name until an embed or the
+        weights change, a cached entry holds its embeds so their memory is not reused.
+        """
+        weight, bias = self.qkv.weight, self.qkv.bias
+        L = next((e.shape[-2] for e, _, _ in spans if e is not None), 1)
+        # inference tensors have no version counter, they can only change in inference mode
+        key = tuple((e.data_ptr(), e.shape, None if e.is_inference() else e._version) if e is not None else None
+                    for e, _, _ in spans) + (
+            weight._version, None if bias is None else bias._version, dtype)
+        cached = self.folded.get(name)
+        if cached is None or cached[0] != key:
+            terms = []
+            with torch.no_grad(), torch.autocast(weight.device.type, enabled=False):
+                for e, start, end in spans:
+                    b = weight.new_zeros(end - start).float() if bias is None else bias[start:end].float()
+                    terms.append(b.expand(1, L, -1) if e is None else F.linear(e.float(), weight[start:end].float(), b))
+            cached = self.folded[name] = (key, [e for e, _, _ in spans], torch.cat(terms, dim=-1).to(dtype))
+        return cached[2]
+
+    def project_folded(self, q, k, q_embed, k_embed, workspace=None):
+        """ project() of q + q_embed, k + k_embed and k as values, with the embeddings folded into the biases """
+        weight = self.qkv.weight
+        D = q.shape[-1]
+        # only used without gradients, the biases are added in place
+        if q is k and q_embed is k_embed:
+            out = workspace_linear(q, weight, None, workspace, 'qkv')
+            return out.add_(self.fold('qkv', [(q_embed, 0, 2 * D), (None, 2 * D, 3 * D)], out.dtype)).chunk(3, -1)
+        q = workspace_linear(q, weight[:D], None, workspace, 'q')
+        q.add_(self.fold('q', [(q_embed, 0, D)], q.dtype))
+        kv = workspace_linear(k, weight[D:], None, workspace, 'kv')
+        kv.add_(self.fold('kv', [(k_embed, D, 2 * D), (None, 2 * D, 3 * D)], kv.dtype))
+        return (q,) + kv.chunk(2, -1)
+
+    def forward(self, q, k, v, grid=None, q_embed=None, k_embed=None, workspace=None):
+        """ Attention of the queries q + q_embed over the keys k + k_embed with values v,
+        the embeddings are added before the projections when given. With a workspace, the
+        projections are written into its buffers, see workspace_body.
+        """
+        N = q.shape[0]
+        windowed = bool(self.window) and grid is not None and max(grid) > self.window
+        if (self.fold_embeddings and not windowed and k is v and isinstance(self.qkv, nn.Linear)
+                and not self.training and not torch.is_grad_enabled()):
+            return self.attend(*self.project_folded(q, k, q_embed, k_embed, workspace), N, workspace=workspace)
+        shared = q is k and q_embed is k_embed
+        if q_embed is not None:
+            q = q + q_embed
+        if shared:
+            k = q
+        elif k_embed is not None:
+            k = k + k_embed
+        mask = None
+        if windowed:
+            # attention runs within each window of the grid q, k and v share; projections are
+            # per token, so the windows are cut before them, once per distinct input
+            windows = {}
+            for t in (q, k, v):
+                if id(t) not in windows:
+                    windows[id(t)] = window_partition(t, grid, self.window, self.shift).flatten(0, 1)
+            q, k, v = windows[id(q)], windows[id(k)], windows[id(v)]
+            mask = window_mask(tuple(grid), self.window, self.shift, q.device)
+        x = self.attend(*self.project(q, k, v, workspace), N, mask, workspace)
+        if windowed:
+            x = window_reverse(x.reshape(N, -1, x.shape[1], x.shape[2]), grid, self.window, self.shift)
+        return x
 
-    def forward(self, q, k, v):
-        N, L, D = q.shape
-        q, k, v = self.query(q), self.key(k), self.value(v)
-        q = q.reshape(N, L, self.num_heads, D // self.num_heads).permute(0, 2, 1, 3)
-        k = k.reshape(N, L, self.num_heads, D // self.num_heads).permute(0, 2, 1, 3)
-        v = v.reshape(N, L, self.num_heads, D // self.num_heads).permute(0, 2, 1, 3)
-
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(N, L, D)
-        x = self.proj(x)
+    def attend(self, q, k, v, N, mask=None, workspace=None):
+        """ Attention of the projected q over k and v, then the output projection.
+        The batch holds N images, each one some windows, mask is per window.
+        """
+        B, L, D = q.shape
+        S = k.shape[1]
+        q = q.reshape(B, L, self.num_heads, D // self.num_heads).transpose(1, 2)
+        k = k.reshape(B, S, self.num_heads, D // self.num_heads).transpose(1, 2)
+        v = v.reshape(B, S, self.num_heads, D // self.num_heads).transpose(1, 2)
+        if mask is not None:
+            # the CPU fused kernel only takes 4-D inputs, the batch is N images of B // N windows
+            mask = mask.expand(N, -1, -1, -1, -1).reshape(B, 1, L, S)
+
+        if _HAS_SDPA and not (self.training and self.attn_drop.p > 0):
+            # fused kernel, never materializes the L x S attention matrix; it accumulates
+            # the softmax in float32 for bfloat16 inputs
+            if _SDPA_SCALE:
+                x = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, scale=self.scale)
+            else:
+                # torch 2.0 scales by head_dim ** -0.5, q is rescaled to self.scale
+                x = F.scaled_dot_product_attention(q * (self.scale * q.shape[-1] ** 0.5), k, v, attn_mask=mask)
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            if mask is not None:
+                attn = attn.masked_fill(~mask, float('-inf'))
+            attn = attn.softmax(dim=-1, dtype=torch.float32).to(v.dtype)
+            attn = self.attn_drop(attn)
+            x = attn @ v
+
+        x = x.transpose(1, 2).reshape(B, L, D)
+        x = apply_linear(self.proj, x, workspace, 'proj')
         x = self.proj_drop(x)
         return x
 
 
+def residual_add(x, y):
+    """ x + y for a freshly computed y, written into y when no gradient is recorded """
+    if not torch.is_grad_enabled() and y.dtype == torch.result_type(x, y):
+        return y.add_(x)
+    return x + y
+
+
 class EncoderLayer(nn.Module):
 
     def __init__(self, dim, num_heads, ffn_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
@@ -73,10 +318,9 @@ class EncoderLayer(nn.Module):
         ffn_hidden_dim = int(dim * ffn_ratio)
         self.ffn = Ffn(in_features=dim, hidden_features=ffn_hidden_dim, act_layer=act_layer, drop=drop)
 
-    def forward(self, x, pos):
-        q, k, v = x + pos, x + pos, x
-        x = x + self.attn(q, k, v)
-        x = x + self.ffn(self.norm2(x))
+    def forward(self, x, pos, grid=None, workspace=None):
+        x = residual_add(x, self.attn(x, x, x, grid, pos, pos, workspace=workspace))
+        x = residual_add(x, self.ffn(self.norm2(x), workspace))
         return x
 
 
@@ -97,15 +341,13 @@ class DecoderLayer(nn.Module):
         ffn_hidden_dim = int(dim * ffn_ratio)
         self.ffn = Ffn(in_features=dim, hidden_features=ffn_hidden_dim, act_layer=act_layer, drop=drop)
 
-    def forward(self, x, pos, task_embed):
+    def forward(self, x, pos, task_embed, grid=None, workspace=None):
         memory = x
         x = self.norm1(x)
-        q, k, v = x + task_embed, x + task_embed, x
-        x = x + self.attn1(q, k, v)
+        x = residual_add(x, self.attn1(x, x, x, grid, task_embed, task_embed, workspace=workspace))
         x = self.norm2(x)
-        q, k, v = x + task_embed, memory + pos, memory
-        x = x + self.attn2(q, k, v)
-        x = x + self.ffn(self.norm3(x))
+        x = residual_add(x, self.attn2(x, memory, memory, grid, task_embed, pos, workspace=workspace))
+        x = residual_add(x, self.ffn(self.norm3(x), workspace))
         return x
 
 
@@ -120,6 +362,8 @@ class ResBlock(nn.Module):
         self.conv2 = nn.Conv2d(channels, channels, kernel_size=5, stride=1,
                                padding=2, bias=False)
         # self.bn2 = nn.BatchNorm2d(channels)
+        # plain add in float, lets the block be statically quantized
+        self.skip_add = FloatFunctional()
 
     def forward(self, x):
         residual = x
@@ -131,7 +375,7 @@ class ResBlock(nn.Module):
         out = self.conv2(out)
         # out = self.bn2(out)
 
-        out += residual
+        out = self.skip_add.add(out, residual)
         # out = self.relu(out)
 
         return out
@@ -173,20 +417,21 @@ class PatchEmbed(nn.Module):
         self.patch_size = patch_size
         self.dim = self.patch_size ** 2 * in_channels
 
-    def forward(self, x):
-        N, C, H, W = ori_shape = x.shape
+    def grid(self, ori_shape):
+        """ (rows, columns) of patches of an ori_shape feature map """
+        return ori_shape[-2] // self.patch_size, ori_shape[-1] // self.patch_size
 
+    def forward(self, x, out=None):
+        N, C, H, W = ori_shape = x.shape
         p = self.patch_size
-        num_patches = (H // p) * (W // p)
-        out = torch.zeros((N, num_patches, self.dim)).to(x.device)
-        # print(f"feature map size: {ori_shape}, embedding size: {out.shape}")
-        i, j = 0, 0
-        for k in range(num_patches):
-            if i + p > W:
-                i = 0
-                j += p
-            out[:, k, :] = x[:, :, i:i + p, j:j + p].flatten(1)
-            i += p
+        nh, nw = H // p, W // p
+        # patches are enumerated column by column (k = col * nh + row), each one
+        # flattened as (C, p, p); this is the layout the pretrained weights expect
+        x = x[:, :, :nh * p, :nw * p].unflatten(2, (nh, p)).unflatten(4, (nw, p)).permute(0, 4, 2, 1, 3, 5)
+        if out is None:
+            return x.reshape(N, nw * nh, self.dim), ori_shape
+        # written straight into the (N, nw * nh, dim) out tensor
+        out.view(N, nw, nh, C, p, p).copy_(x)
         return out, ori_shape
 
 
@@ -202,19 +447,24 @@ class DePatchEmbed(nn.Module):
         self.num_patches = None
         self.dim = self.patch_size ** 2 * in_channels
 
-    def forward(self, x, ori_shape):
+    def forward(self, x, ori_shape, out=None):
         N, num_patches, dim = x.shape
         _, C, H, W = ori_shape
         p = self.patch_size
-        out = torch.zeros(ori_shape).to(x.device)
-        i, j = 0, 0
-        for k in range(num_patches):
-            if i + p > W:
-                i = 0
-                j += p
-            out[:, :, i:i + p, j:j + p] = x[:, k, :].reshape(N, C, p, p)
-            # out[:, k, :] = x[:, :, i:i+p, j:j+p].flatten(1)
-            i += p
+        nh, nw = H // p, W // p
+        x = x.reshape(N, nw, nh, C, p, p).permute(0, 3, 2, 4, 1, 5)
+        if out is not None:
+            # written straight into the (N, C, H, W) out tensor
+            if nh * p != H or nw * p != W:
+                out.zero_()
+            out[:, :, :nh * p, :nw * p].unflatten(2, (nh, p)).unflatten(4, (nw, p)).copy_(x)
+            return out
+        x = x.reshape(N, C, nh * p, nw * p)
+        if nh * p == H and nw * p == W:
+            return x
+        # borders not covered by a whole patch are left at zero
+        out = x.new_zeros((N, C, H, W))
+        out[:, :, :nh * p, :nw * p] = x
         return out
 
 
@@ -254,25 +504,277 @@ class Tail(nn.Module):
         return out
 
 
-class ImageProcessingTransformer(nn.Module):
+def resize_token_grid(embed, grid, size):
+    """ Bicubic resize of a (1, gh * gw, D) token embedding from grid=(gh, gw) to size=(nh, nw).
+    Tokens are laid out column by column, the way PatchEmbed enumerates patches.
+    """
+    (gh, gw), (nh, nw) = grid, size
+    D = embed.shape[-1]
+    x = embed.reshape(1, gw, gh, D).permute(0, 3, 2, 1)
+    x = F.interpolate(x, size=(nh, nw), mode='bicubic', align_corners=False)
+    return x.permute(0, 3, 2, 1).reshape(1, nw * nh, D)
+
+
+def tile_token_grid(embed, grid, size):
+    """ (1, gh * gw, D) token embedding of a grid=(gh, gw) grid repeated over a size=(nh, nw)
+    grid, so every grid aligned gh x gw window of tokens gets the embedding it was trained with.
+    """
+    (gh, gw), (nh, nw) = grid, size
+    D = embed.shape[-1]
+    x = embed.reshape(1, gw, gh, D).repeat(1, -(-nw // gw), -(-nh // gh), 1)
+    return x[:, :nw, :nh].reshape(1, nw * nh, D)
+
+
+def interpolated_embeddings(module, task_embed, ori_shape, key=None, resize=resize_token_grid):
+    """ module.pos_embed and task_embed, learned on the 48x48 token grid, resized to the
+    grid of an ori_shape feature map by resize. Results are cached in module per grid size
+    while no gradient is needed, and recomputed once the embeddings are modified. They are
+    built outside inference mode, so they keep a version counter for Attention.fold and
+    serve forwards in and out of inference mode alike.
+    """
+    p = module.patch_embedding.patch_size
+    grid, size = (48 // p, 48 // p), module.patch_embedding.grid(ori_shape)
+    pos_embed = module.pos_embed
+    if size == grid:
+        return pos_embed, task_embed
+    if torch.is_grad_enabled() and (pos_embed.requires_grad or task_embed.requires_grad):
+        return resize(pos_embed, grid, size), resize(task_embed, grid, size)
+    version = (pos_embed._version, task_embed._version)
+    cache_key = (key, resize.__name__, size, pos_embed.dtype, pos_embed.device)
+    cached = module.embed_cache.get(cache_key)
+    if cached is None or cached[0] != version:
+        with torch.no_grad(), torch.inference_mode(False):
+            cached = (version, resize(pos_embed, grid, size), resize(task_embed, grid, size))
+        module.embed_cache[cache_key] = cached
+    return cached[1], cached[2]
+
+
+def set_fold_embeddings(module, fold):
+    """ Fold the pos and task embeddings into the query/key biases of every Attention
+    of module when it runs without gradients in eval mode, see Attention.fold
+    """
+    for m in module.modules():
+        if isinstance(m, Attention):
+            m.fold_embeddings = fold
+            m.folded = {}
+
+
+def set_window_attention(module, window):
+    """ Window attention in window x window token windows for every Attention of the
+    encoder and decoder of module, or global attention for window=0. Blocks alternate
+    between regular and half window shifted windows, so information crosses windows.
+    """
+    for i, blk in enumerate(list(module.encoder) + list(module.decoder)):
+        for m in blk.modules():
+            if isinstance(m, Attention):
+                m.window = window
+                m.shift = window // 2 if i % 2 else 0
+
+
+class ChannelAttention(nn.Sequential):
+    """ Channel weights of the concatenation of its inputs, the first layer a global average
+    pool. The pool is taken per input, so the full channel concatenation of the branch
+    features is never built; the layers stay those of the Sequential, with the same keys.
+    """
+
+    def forward(self, *branches):
+        x = torch.cat([self[0](t) for t in branches], dim=1)
+        for layer in list(self)[1:]:
+            x = layer(x)
+        return x
+
+
+def fuse_branches(ca, x, x2, x3, out=None):
+    """ Channel attention fusion of the three branch features by a ChannelAttention ca;
+    out, when given, receives the weighted sum in place.
+    """
+    w = ca(x, x2, x3)
+    w = w.view(-1, 3, x.shape[1])[:, :, :, None, None].to(x.dtype)
+    if out is None:
+        return w[:, 0] * x + w[:, 1] * x2 + w[:, 2] * x3
+    torch.mul(x, w[:, 0], out=out)
+    out.addcmul_(x2, w[:, 1])
+    return out.addcmul_(x3, w[:, 2])
+
+
+class Workspace(object):
+    """ Tensors reused across inference forwards, keyed by name, shape past the batch
+    dimension, dtype and device. A buffer holds the largest batch it was asked for and
+    smaller batches get a view of its first rows, so memory is bounded by one buffer per
+    key whatever the batch sizes. Buffers and counters are per thread, so concurrent
+    forwards never share a buffer.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def state(self):
+        local = self.local
+        if not hasattr(local, 'buffers'):
+            local.buffers = {}
+            local.counts = {'allocations': 0, 'reuses': 0, 'allocated_bytes': 0}
+        return local
+
+    def begin(self):
+        """ Start the counters of a new forward """
+        self.state().counts = {'allocations': 0, 'reuses': 0, 'allocated_bytes': 0}
+
+    def get(self, name, shape, dtype, device):
+        """ Uninitialized contiguous shape tensor, the leading rows of the buffer of its key;
+        the buffer is allocated again when the key is new in this thread or the batch larger.
+        Buffers are normal tensors, written in place by forwards in and out of inference mode.
+        """
+        local = self.state()
+        key = (name, tuple(shape[1:]), dtype, torch.device(device))
+        buf = local.buffers.get(key)
+        if buf is None or buf.shape[0] < shape[0]:
+            with torch.inference_mode(False):
+                buf = local.buffers[key] = torch.empty(shape, dtype=dtype, device=device)
+            local.counts['allocations'] += 1
+            local.counts['allocated_bytes'] += buf.numel() * buf.element_size()
+        else:
+            local.counts['reuses'] += 1
+        return buf[:shape[0]]
+
+    def profile(self, fn, min_bytes=1 << 20):
+        """ fn() under the profiler. The large_allocations and large_allocated_bytes counts
+        of the thread then cover every operator that allocated min_bytes or more, inside
+        the workspace or not, see profiling.large_allocations. One profiler at a time.
+        """
+        from profiling import large_allocations
+        result = []
+        allocations = large_allocations(lambda: result.append(fn()), min_bytes)
+        counts = self.state().counts
+        counts['large_allocations'] = len(allocations)
+        counts['large_allocated_bytes'] = sum(n for _, n in allocations)
+        return result[0]
+
+    @property
+    def counts(self):
+        """ Buffers allocated and reused by the last forward of the calling thread, and its
+        large allocations when it ran under profile
+        """
+        return dict(self.state().counts)
+
+    def clear(self):
+        self.local = threading.local()
+
+
+def workspace_body(model, workspace, x, x2, x3):
+    """ Batched transformer and fusion of the branch features, before the Tail, with the
+    intermediate tensors in workspace buffers: the branches are patch embedded straight
+    into one token batch, de patch embedded into one feature batch and fused in place.
+    The linear layers of the blocks write their outputs into buffers per role, the
+    projections and the Ffn hidden layer are consumed within their module; the 'proj'
+    and 'fc2' outputs carry the residual stream, each block reads the one it got before
+    writing it again, as the normalized inputs of the sublayers are fresh tensors.
+    The result is a workspace buffer, valid until the next forward of the thread.
+    """
+    workspace.begin()
+    N, ori_shape = x.shape[0], x.shape
+    grid = model.patch_embedding.grid(ori_shape)
+    tokens = workspace.get('tokens', (3 * N, grid[0] * grid[1], model.patch_embedding.dim), x.dtype, x.device)
+    for i, t in enumerate((x, x2, x3)):
+        model.patch_embedding(t, out=tokens[i * N:(i + 1) * N])
+    pos, task_embed = model.embeddings(ori_shape, tokens.shape[1])
+    for blk in model.encoder:
+        tokens = blk(tokens, pos, grid=grid, workspace=workspace)
+    for blk in model.decoder:
+        tokens = blk(tokens, pos, task_embed, grid=grid, workspace=workspace)
+    features = workspace.get('features', (3 * N,) + tuple(ori_shape[1:]), tokens.dtype, x.device)
+    x, x2, x3 = model.de_patch_embedding(tokens, ori_shape, out=features).unflatten(0, (3, -1)).unbind(0)
+    return fuse_branches(model.ca, x, x2, x3, out=workspace.get('fused', x.shape, x.dtype, x.device))
+
+
+class TransformerOptions(object):
+    """ Inference options of the shared transformer body, mixed into ImageProcessingTransformer
+    and SingleTaskTransformer. Classes provide patch_embedding, pos_embed, encoder, decoder,
+    task_id, the interpolate_embeddings, window_attention, embed_cache and workspace
+    attributes, and task_embedding() returning the (1, tokens, D) embedding of task_id.
+    """
+
+    def set_interpolate_embeddings(self, interpolate):
+        """ Bicubically interpolate the pos and task embeddings to the token grid of the input
+        instead of slicing them, so inputs of any size multiple of the patch size get the
+        positions they would have on a 48x48 grid.
+        """
+        self.interpolate_embeddings = interpolate
+        self.embed_cache = {}
+
+    def set_fold_embeddings(self, fold):
+        set_fold_embeddings(self, fold)
+
+    def set_workspace(self, enabled):
+        """ Keep the token, feature and fusion tensors and the linear outputs of the blocks
+        of batched forwards without gradients in eval mode in a Workspace, reused by later
+        forwards up to the largest batch seen; model.workspace.counts tells what the last
+        forward allocated, model.workspace.profile also counts what it allocated outside.
+        """
+        self.workspace = Workspace() if enabled else None
+
+    def active_workspace(self):
+        if self.workspace is not None and not self.training and not torch.is_grad_enabled():
+            return self.workspace
+        return None
+
+    def set_window_attention(self, window_attention):
+        """ Shifted window attention over windows of the 48x48 token grid the model was
+        trained on, with the same weights, so larger inputs cost time and memory linear
+        in their size instead of quadratic. Every window gets the trained embeddings.
+        Modules sharing the encoder and decoder switch together.
+        """
+        self.window_attention = window_attention
+        self.embed_cache = {}
+        set_window_attention(self, 48 // self.patch_embedding.patch_size if window_attention else 0)
+
+    def embeddings(self, ori_shape, tokens):
+        """ pos and task embeddings for the tokens of an ori_shape feature map """
+        task_embed = self.task_embedding()
+        if self.window_attention:
+            return interpolated_embeddings(self, task_embed, ori_shape, key=self.task_id, resize=tile_token_grid)
+        if self.interpolate_embeddings:
+            return interpolated_embeddings(self, task_embed, ori_shape, key=self.task_id)
+        return self.pos_embed[:, :tokens], task_embed[:, :tokens]
+
+
+class ImageProcessingTransformer(TransformerOptions, nn.Module):
     """ Vision Transformer with support for patch or hybrid CNN input stage
     """
 
     def __init__(self, patch_size=1, in_channels=3, mid_channels=64, num_classes=1000, depth=12,
                  num_heads=8, ffn_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
-                 norm_layer=nn.LayerNorm):
+                 norm_layer=nn.LayerNorm, batch_branches=True, tasks=None):
         super(ImageProcessingTransformer, self).__init__()
 
         self.task_id = None
+        # run the encoder/decoder once over the three stacked branches
+        self.batch_branches = batch_branches
+        # recompute in backward instead of keeping activations, see set_checkpointing
+        self.checkpoint_heads = False
+        self.checkpoint_blocks = False
+        # resize the embeddings to inputs larger than 48x48, see set_interpolate_embeddings
+        self.interpolate_embeddings = False
+        self.embed_cache = {}
+        # shifted window attention for large inputs, see set_window_attention
+        self.window_attention = False
+        # reused intermediate tensors at inference, see set_workspace
+        self.workspace = None
         self.num_classes = num_classes
         self.embed_dim = patch_size * patch_size * mid_channels
-        self.headsets = nn.ModuleList([Head(in_channels, mid_channels) for _ in range(6)])
-        self.headsets2 = nn.ModuleList([Head(mid_channels, mid_channels) for _ in range(6)])
-        self.headsets3 = nn.ModuleList([Head(mid_channels, mid_channels) for _ in range(6)])
+        # heads and tails are only allocated for tasks, the others get parameter free
+        # placeholders so task_id still indexes the sets
+        tasks = range(6) if tasks is None else tasks
+
+        def task_modules(build):
+            return nn.ModuleList([build(id) if id in tasks else nn.Identity() for id in range(6)])
+
+        self.headsets = task_modules(lambda _: Head(in_channels, mid_channels))
+        self.headsets2 = task_modules(lambda _: Head(mid_channels, mid_channels))
+        self.headsets3 = task_modules(lambda _: Head(mid_channels, mid_channels))
         self.patch_embedding = PatchEmbed(patch_size=patch_size, in_channels=mid_channels)
 
         self.embed_dim = self.patch_embedding.dim
-        self.ca = nn.Sequential(*[
+        self.ca = ChannelAttention(*[
             nn.AdaptiveAvgPool2d(1),
             nn.Conv2d(192, 64 // 16, 1, padding=0),
             nn.ReLU(inplace=True),
@@ -298,7 +800,7 @@ class ImageProcessingTransformer(nn.Module):
 
         self.de_patch_embedding = DePatchEmbed(patch_size=patch_size, in_channels=mid_channels)
         # tail
-        self.tailsets = nn.ModuleList([Tail(id, mid_channels, in_channels) for id in range(6)])
+        self.tailsets = task_modules(lambda id: Tail(id, mid_channels, in_channels))
 
         trunc_normal_(self.pos_embed, std=.02)
         self.apply(self._init_weights)
@@ -306,6 +808,26 @@ class ImageProcessingTransformer(nn.Module):
     def set_task(self, task_id):
         self.task_id = task_id
 
+    def set_batch_branches(self, batch_branches):
+        self.batch_branches = batch_branches
+
+    def set_checkpointing(self, heads=False, blocks=False):
+        """ Activation checkpointing of each branch Head stack and/or of each encoder and
+        decoder block: only their inputs are kept for backward, which runs them again;
+        recomputing() tells forward hooks apart from the first run.
+        """
+        self.checkpoint_heads = heads
+        self.checkpoint_blocks = blocks
+
+    def task_embedding(self):
+        return self.task_embed[self.task_id]
+
+    def _run(self, module, checkpointed, *args, **kwargs):
+        if checkpointed and self.training and torch.is_grad_enabled():
+            return checkpoint(module, *args, use_reentrant=False,
+                              context_fn=lambda: (contextlib.nullcontext(), _recompute_context()), **kwargs)
+        return module(*args, **kwargs)
+
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
             trunc_normal_(m.weight, std=.02)
@@ -319,34 +841,102 @@ class ImageProcessingTransformer(nn.Module):
         self.task_id = 5
         assert 0 <= self.task_id <= 5
         # print("input shape:", x.shape, x.device)
-        x = self.headsets[self.task_id](x)
-        x2 = self.headsets2[self.task_id](x)
-        x3 = self.headsets3[self.task_id](x2)
+        x = self._run(self.headsets[self.task_id], self.checkpoint_heads, x)
+        x2 = self._run(self.headsets2[self.task_id], self.checkpoint_heads, x)
+        x3 = self._run(self.headsets3[self.task_id], self.checkpoint_heads, x2)
+        workspace = self.active_workspace()
+        if workspace is not None and self.batch_branches:
+            return self.tailsets[self.task_id](workspace_body(self, workspace, x, x2, x3))
         x, ori_shape = self.patch_embedding(x)
         x2, ori_shape2 = self.patch_embedding(x2)
         x3, ori_shape3 = self.patch_embedding(x3)
         # print("embedding shape:", x.shape)
         # print(x.device, self.pos_embed.device)
-        for blk in self.encoder:
-            x = blk(x, self.pos_embed[:, :x.shape[1]])
-            x2 = blk(x2, self.pos_embed[:, :x2.shape[1]])
-            x3 = blk(x3, self.pos_embed[:, :x3.shape[1]])
-        for blk in self.decoder:
-            x = blk(x, self.pos_embed[:, :x.shape[1]], self.task_embed[self.task_id, :, :x.shape[1]])
-            x2 = blk(x2, self.pos_embed[:, :x2.shape[1]], self.task_embed[self.task_id, :, :x2.shape[1]])
-            x3 = blk(x3, self.pos_embed[:, :x3.shape[1]], self.task_embed[self.task_id, :, :x3.shape[1]])
+        pos, task_embed = self.embeddings(ori_shape, x.shape[1])
+        grid = self.patch_embedding.grid(ori_shape)
+        if self.batch_branches:
+            # the three branches share the transformer weights, stack them along
+            # the batch so every block runs once instead of three times
+            N = x.shape[0]
+            tokens = torch.cat([x, x2, x3])
+            for blk in self.encoder:
+                tokens = self._run(blk, self.checkpoint_blocks, tokens, pos, grid=grid)
+            for blk in self.decoder:
+                tokens = self._run(blk, self.checkpoint_blocks, tokens, pos, task_embed, grid=grid)
+            x, x2, x3 = tokens.split(N)
+        else:
+            for blk in self.encoder:
+                x, x2, x3 = [self._run(blk, self.checkpoint_blocks, t, pos, grid=grid) for t in (x, x2, x3)]
+            for blk in self.decoder:
+                x, x2, x3 = [self._run(blk, self.checkpoint_blocks, t, pos, task_embed, grid=grid)
+                             for t in (x, x2, x3)]
         x = self.de_patch_embedding(x, ori_shape)
         x2 = self.de_patch_embedding(x2, ori_shape2)
         x3 = self.de_patch_embedding(x3, ori_shape3)
-        w = self.ca(torch.cat([x, x2, x3], dim=1))
-        w = w.view(-1, 3, 64)[:, :, :, None, None]
-        out = w[:, 0, ::] * x + w[:, 1, ::] * x2 + w[:, 2, ::] * x3
+        out = fuse_branches(self.ca, x, x2, x3)
         # x = self.tailsets[self.task_id](x)
         out = self.tailsets[self.task_id](out)
         # x = self.norm(x)
         return out
 
 
+class SingleTaskTransformer(TransformerOptions, nn.Module):
+    """ One task of an ImageProcessingTransformer as a static module
+    Holds only the Heads, task embedding and Tail of task_id, with no mutable task
+    attribute, so the whole forward can be traced, scripted or compiled as one graph.
+    Submodules are shared with the source model.
+    """
+
+    def __init__(self, model, task_id=5):
+        super(SingleTaskTransformer, self).__init__()
+        assert 0 <= task_id <= 5
+        self.task_id = task_id
+        self.head = model.headsets[task_id]
+        self.head2 = model.headsets2[task_id]
+        self.head3 = model.headsets3[task_id]
+        self.patch_embedding = model.patch_embedding
+        self.pos_embed = model.pos_embed
+        self.task_embed = nn.Parameter(model.task_embed.detach()[task_id].clone())
+        self.encoder = model.encoder
+        self.decoder = model.decoder
+        self.de_patch_embedding = model.de_patch_embedding
+        self.ca = model.ca
+        self.tail = model.tailsets[task_id]
+        self.interpolate_embeddings = model.interpolate_embeddings
+        self.window_attention = model.window_attention
+        self.embed_cache = {}
+        self.workspace = None
+
+    def heads(self, x):
+        """ Features of the three branches, convolutions only """
+        x = self.head(x)
+        x2 = self.head2(x)
+        return x, x2, self.head3(x2)
+
+    def task_embedding(self):
+        return self.task_embed
+
+    def body(self, x, x2, x3):
+        """ Transformer over the branch features and their channel attention fusion, before the Tail """
+        workspace = self.active_workspace()
+        if workspace is not None:
+            return workspace_body(self, workspace, x, x2, x3)
+        # the three branches go through the transformer as one batch
+        tokens, ori_shape = self.patch_embedding(torch.cat([x, x2, x3]))
+        pos, task_embed = self.embeddings(ori_shape, tokens.shape[1])
+        grid = self.patch_embedding.grid(ori_shape)
+        for blk in self.encoder:
+            tokens = blk(tokens, pos, grid=grid)
+        for blk in self.decoder:
+            tokens = blk(tokens, pos, task_embed, grid=grid)
+        # unflatten rather than split(N), so a traced graph keeps the batch size dynamic
+        x, x2, x3 = self.de_patch_embedding(tokens, ori_shape).unflatten(0, (3, -1)).unbind(0)
+        return fuse_branches(self.ca, x, x2, x3)
+
+    def forward(self, x):
+        return self.tail(self.body(*self.heads(x)))
+
+
 def _no_grad_trunc_normal_(tensor, mean, std, a, b):
     # Cut & paste from PyTorch official master until it's in a few official releases - RW
     # Method based on https://people.sc.fsu.edu/~jburkardt/presentations/truncated_normal.pdf
@@ -407,15 +997,39 @@ def trunc_normal_(tensor, mean=0., std=1., a=-2., b=2.):
 def TD_base(**kwargs):
     model = ImageProcessingTransformer(
         patch_size=4, depth=1, num_heads=1, ffn_ratio=4, qkv_bias=True,
-        norm_layer=partial(nn.LayerNorm, eps=1e-6), **kwargs)
+        norm_layer=partial(FP32LayerNorm, eps=1e-6), **kwargs)
     return model
 
 
+def TD_single(task_id=5, **kwargs):
+    """ TD_base with only the Heads, task embedding and Tail of task_id ever allocated """
+    return SingleTaskTransformer(TD_base(tasks=[task_id], **kwargs), task_id)
+
+
+def single_task_state_dict(state_dict, task_id=5):
+    """ Map a full TD_base state dict onto TD_single(task_id), dropping the other tasks """
+    prefixes = {'headsets.{}.'.format(task_id): 'head.', 'headsets2.{}.'.format(task_id): 'head2.',
+                'headsets3.{}.'.format(task_id): 'head3.', 'tailsets.{}.'.format(task_id): 'tail.'}
+    out = {}
+    for k, v in state_dict.items():
+        if k.startswith('module.'):
+            k = k[len('module.'):]
+        if k == 'task_embed':
+            out[k] = v[task_id].clone()
+        elif k.startswith(('headsets', 'tailsets')):
+            for prefix, new in prefixes.items():
+                if k.startswith(prefix):
+                    out[new + k[len(prefix):]] = v
+        else:
+            out[k] = v
+    return out
+
+
 if __name__ == "__main__":
-    net = ipt_base()
+    net = TD_base()
 
     input = torch.ones((1, 3, 48, 48))
     # input = input.cuda()
     output = net(input)
     # writer.add_graph(net,input)
-    print(net)
\ No newline at end of file
+    print(net)
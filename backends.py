@@ -0,0 +1,30 @@
+import torch
+
+
+class OnnxBackend(object):
+    """ ONNX Runtime session of a model exported by export.py, called like the torch model:
+    an N 3 48 48 float tensor in, the dehazed N 3 48 48 tensor out. TiledDehazer and
+    Dehazer take it in place of a model.
+    """
+
+    def __init__(self, path, threads=None):
+        # imported here, so torch only runs never load onnxruntime
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("the onnx backend needs onnxruntime, pip install onnxruntime")
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        # tiles are already batched, parallel graph branches only oversubscribe the cores
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.device = torch.device('cpu')
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        x = x.detach().to('cpu', torch.float32).contiguous()
+        return torch.from_numpy(self.session.run(None, {self.input_name: x.numpy()})[0])
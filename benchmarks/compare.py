@@ -0,0 +1,42 @@
+import argparse
+import json
+import sys
+
+parser = argparse.ArgumentParser(description='Compare two benchmark json files and flag regressions')
+parser.add_argument('base', metavar='BASE', help='reference run written by benchmarks.suite')
+parser.add_argument('new', metavar='NEW', help='run to check against the reference')
+parser.add_argument('--threshold', default=0.1, type=float,
+                    help='relative slow down counted as a regression (default: 0.1)')
+
+
+def compare(base, new, threshold=0.1):
+    """ (name, base seconds, new seconds, ratio, regressed) for the cases of both runs """
+    rows = []
+    for name in sorted(set(base) & set(new)):
+        b, n = base[name]['seconds'], new[name]['seconds']
+        ratio = n / b if b > 0 else float('inf')
+        rows.append((name, b, n, ratio, ratio > 1 + threshold))
+    return rows
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.base) as f:
+        base = json.load(f)['results']
+    with open(args.new) as f:
+        new = json.load(f)['results']
+
+    rows = compare(base, new, args.threshold)
+    for name, b, n, ratio, regressed in rows:
+        print('{:<40}\t{:.2f} ms\t{:.2f} ms\t{:.2f}x{}'.format(
+            name, b * 1000, n * 1000, ratio, '\tREGRESSION' if regressed else ''))
+    for name in sorted(set(base) ^ set(new)):
+        print('{:<40}\tonly in {}'.format(name, args.base if name in base else args.new))
+
+    regressions = [row[0] for row in rows if row[-1]]
+    print(' * {} cases compared, {} regressions over {:.0%}'.format(len(rows), len(regressions), args.threshold))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
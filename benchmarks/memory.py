@@ -0,0 +1,82 @@
+import argparse
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from TD_multi import TD_base
+
+MODES = {'none': (False, False), 'heads': (True, False), 'blocks': (False, True), 'all': (True, True)}
+
+parser = argparse.ArgumentParser(description='Peak memory against step time of activation checkpointing on CPU')
+parser.add_argument('-b', '--batch-sizes', default=[16, 64], type=int, nargs='+', metavar='N',
+                    help='48x48 crops per step (default: 16 64)')
+parser.add_argument('--modes', default=list(MODES), nargs='+', choices=list(MODES),
+                    help='checkpointing modes to compare (default: all of them)')
+parser.add_argument('--steps', default=3, type=int, metavar='N', help='timed training steps (default: 3)')
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def saved_bytes(model, x):
+    """ Output of model(x) and the bytes of activations autograd keeps for its backward.
+    Tensors inside checkpointed regions are never saved, so they are not counted.
+    """
+    params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    storages = {}
+
+    def pack(t):
+        storage = t.untyped_storage()
+        if storage.data_ptr() not in params:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = model(x)
+    return out, sum(storages.values())
+
+
+def measure_mode(mode, batch_size, steps):
+    """ Activations saved for backward, peak RSS growth over the model and median
+    forward + backward time, in a fresh process
+    """
+    torch.manual_seed(0)
+    model = TD_base().train()
+    model.set_checkpointing(*MODES[mode])
+    x = torch.randn(batch_size, 3, 48, 48)
+    target = torch.randn(batch_size, 3, 48, 48)
+    base = peak_rss()
+    times = []
+    for _ in range(steps):
+        model.zero_grad(set_to_none=True)
+        start = time.perf_counter()
+        out, saved = saved_bytes(model, x)
+        torch.nn.functional.l1_loss(out, target).backward()
+        times.append(time.perf_counter() - start)
+    return {'saved_mb': saved / 2 ** 20, 'peak_mb': (peak_rss() - base) / 2 ** 20,
+            'step': sorted(times)[len(times) // 2]}
+
+
+def main():
+    args = parser.parse_args()
+    for batch_size in args.batch_sizes:
+        results = {}
+        for mode in args.modes:
+            # one process per run, ru_maxrss never goes down
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                results[mode] = pool.submit(measure_mode, mode, batch_size, args.steps).result()
+        base = results.get('none', results[args.modes[0]])
+        for mode, r in results.items():
+            print('batch {}\t{:<6}\tsaved {:8.1f} MB ({:5.1f}%)\tpeak {:8.1f} MB ({:5.1f}%)\t'
+                  'step {:.3f}s ({:+.1f}%)'.format(
+                      batch_size, mode, r['saved_mb'], 100 * r['saved_mb'] / base['saved_mb'], r['peak_mb'],
+                      100 * r['peak_mb'] / base['peak_mb'], r['step'], 100 * (r['step'] / base['step'] - 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import argparse
+import glob
+import os
+import time
+
+import torch
+from PIL import Image
+import torchvision.transforms.functional as TF
+
+from dehaze import load_model
+from quantize import psnr
+from tiling import TiledDehazer
+from benchmarks.suite import ROOT, measure
+
+parser = argparse.ArgumentParser(description='Throughput and PSNR of bfloat16 autocast against fp32 on CPU')
+parser.add_argument('--resume', default='', type=str, metavar='PATH',
+                    help='checkpoint saved by save_checkpoint (default: random weights)')
+parser.add_argument('--images', default=os.path.join(ROOT, 'real_*.jpg'), type=str, metavar='GLOB',
+                    help='images to dehaze (default: the real_*.jpg samples)')
+parser.add_argument('-b', '--batch-size', default=16, type=int, metavar='N',
+                    help='48x48 crops per training step and tiles per forward (default: 16)')
+parser.add_argument('--iters', default=3, type=int, metavar='N', help='timed training steps (default: 3)')
+
+PRECISIONS = (('fp32', None), ('bf16', torch.bfloat16))
+
+
+def train_step(model, x, target, dtype):
+    model.zero_grad(set_to_none=True)
+    with torch.autocast('cpu', dtype=dtype, enabled=dtype is not None):
+        output = model(x)
+    torch.nn.functional.l1_loss(output.float(), target).backward()
+
+
+def main():
+    args = parser.parse_args()
+    model = load_model(args.resume)
+    images = [TF.to_tensor(Image.open(p).convert('RGB')) * 2 - 1 for p in sorted(glob.glob(args.images))]
+
+    x = torch.randn(args.batch_size, 3, 48, 48)
+    target = torch.randn(args.batch_size, 3, 48, 48)
+    model.train()
+    for name, dtype in PRECISIONS:
+        r = measure(lambda: train_step(model, x, target, dtype), args.iters, items=args.batch_size)
+        print('train {}\t{:.1f} samples/sec'.format(name, r['items_per_sec']))
+    model.eval()
+
+    outputs, seconds = {}, {}
+    for name, dtype in PRECISIONS:
+        tiler = TiledDehazer(model, batch_size=args.batch_size, dtype=dtype)
+        outputs[name], tiles = [], 0
+        start = time.time()
+        for image in images:
+            outputs[name].append(tiler(image))
+            tiles += tiler.stats.tiles
+        seconds[name] = time.time() - start
+        print('dehaze {}\t{:.2f} images/sec\t{:.1f} tiles/sec'.format(
+            name, len(images) / seconds[name], tiles / seconds[name]))
+    values = [psnr(bf16, fp32) for bf16, fp32 in zip(outputs['bf16'], outputs['fp32'])]
+    print(' * bf16 speedup {:.2f}x\tPSNR bf16 vs fp32 mean {:.2f} min {:.2f}'.format(
+        seconds['fp32'] / seconds['bf16'], sum(values) / len(values), min(values)))
+
+
+if __name__ == '__main__':
+    main()
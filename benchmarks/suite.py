@@ -0,0 +1,181 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import torch
+from PIL import Image
+
+from TD_multi import TD_base
+from dehaze import Dehazer
+from haze_data import PairedHazeDataset, PairedCropSampler
+from haze_shard import ShardDataset, pack_shard
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECTIONS = ('modules', 'model', 'data', 'e2e')
+
+parser = argparse.ArgumentParser(description='CPU benchmarks of TransDehaze, written as json')
+parser.add_argument('-o', '--output', default='benchmark.json', type=str, metavar='PATH',
+                    help='where to write the results (default: benchmark.json)')
+parser.add_argument('--only', default=list(SECTIONS), nargs='+', choices=SECTIONS,
+                    help='sections to run (default: all)')
+parser.add_argument('--batch-sizes', default=[1, 8, 32], type=int, nargs='+', metavar='N',
+                    help='batch sizes for the module and model sections (default: 1 8 32)')
+parser.add_argument('--threads', default=None, type=int, nargs='+', metavar='N',
+                    help='intra-op thread counts for the model section (default: torch.get_num_threads())')
+parser.add_argument('--iters', default=5, type=int, metavar='N', help='timed iterations per case (default: 5)')
+parser.add_argument('--data', default='', type=str, metavar='DIR',
+                    help='dataset with input/ and ref/ for the data section (default: the real_*.jpg samples)')
+parser.add_argument('--images', default=os.path.join(ROOT, 'real_*.jpg'), type=str, metavar='GLOB',
+                    help='images dehazed by the e2e section (default: the real_*.jpg samples)')
+
+
+def measure(fn, iters=5, warmup=1, items=1):
+    """ Median, mean and best seconds of fn() over iters calls, with items processed per call """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    median = times[len(times) // 2]
+    return {'seconds': median, 'mean': sum(times) / len(times), 'min': times[0],
+            'items_per_sec': items / median if median > 0 else 0.}
+
+
+def bench_modules(model, batch_sizes, iters):
+    """ Forward latency of every stage of TD_base, on the shapes it sees in the model """
+    head = model.headsets[5]
+    dim = model.embed_dim
+    tokens = (48 // model.patch_embedding.patch_size) ** 2
+    pos, task_embed = model.pos_embed.detach(), model.task_embed.detach()[5]
+    results = {}
+    for b in batch_sizes:
+        feat = torch.randn(b, 64, 48, 48)
+        x = torch.randn(b, tokens, dim)
+        cases = {
+            'Head': (head, (torch.randn(b, 3, 48, 48),)),
+            'PatchEmbed': (model.patch_embedding, (feat,)),
+            'EncoderLayer': (model.encoder[0], (x, pos)),
+            'DecoderLayer': (model.decoder[0], (x, pos, task_embed)),
+            'DePatchEmbed': (model.de_patch_embedding, (x, feat.shape)),
+            'ca': (model.ca, (feat, torch.randn(b, 64, 48, 48), torch.randn(b, 64, 48, 48))),
+            'Tail': (model.tailsets[5], (feat,)),
+        }
+        for name, (module, args) in cases.items():
+            with torch.no_grad():
+                results['modules/{}/b{}'.format(name, b)] = measure(lambda: module(*args), iters, items=b)
+        # the blocks again with the projected embeddings folded into the attention biases
+        model.set_fold_embeddings(True)
+        for name in ('EncoderLayer', 'DecoderLayer'):
+            module, args = cases[name]
+            with torch.no_grad():
+                results['modules/{}Folded/b{}'.format(name, b)] = measure(lambda: module(*args), iters, items=b)
+        model.set_fold_embeddings(False)
+    return results
+
+
+def bench_model(model, batch_sizes, threads, iters):
+    """ Full forward in eval mode and forward + backward in train mode """
+    results = {}
+    default_threads = torch.get_num_threads()
+    for t in threads:
+        torch.set_num_threads(t)
+        for b in batch_sizes:
+            x = torch.randn(b, 3, 48, 48)
+
+            def forward():
+                with torch.no_grad():
+                    model(x)
+
+            def backward():
+                model.zero_grad(set_to_none=True)
+                model(x).abs().mean().backward()
+
+            model.eval()
+            results['model/forward/b{}/t{}'.format(b, t)] = measure(forward, iters, items=b)
+            model.train()
+            results['model/backward/b{}/t{}'.format(b, t)] = measure(backward, iters, items=b)
+    model.eval()
+    torch.set_num_threads(default_threads)
+    return results
+
+
+def bench_data(data, images, iters):
+    """ Pair decode throughput of the lazy image dataset and of a memory-mapped shard """
+    tmp = tempfile.mkdtemp()
+    try:
+        if not data:
+            # pair every sample image with itself
+            data = tmp
+            for sub in ('input', 'ref'):
+                os.makedirs(os.path.join(tmp, sub))
+                for path in images:
+                    shutil.copy(path, os.path.join(tmp, sub))
+        lazy = PairedHazeDataset(data)
+        pack_shard(lazy.pairs, os.path.join(tmp, 'pairs.shard'))
+        shard = ShardDataset(os.path.join(tmp, 'pairs.shard'), crop_size=None)
+        crops = PairedCropSampler(shard, crops_per_image=16)
+
+        def read(dataset):
+            return lambda: [dataset[i] for i in range(len(dataset))]
+
+        return {
+            'data/decode': measure(read(lazy), iters, items=len(lazy)),
+            'data/shard': measure(read(shard), iters, items=len(shard)),
+            'data/shard_crops16': measure(read(crops), iters, items=len(crops) * 16),
+        }
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_e2e(model, images, iters):
+    """ Decode, tile, dehaze, blend and encode of each image, as dehaze.py does it """
+    dehazer = Dehazer(model)
+    results = {}
+    for path in images:
+        with Image.open(path) as image:
+            image.load()
+        results['e2e/{}'.format(os.path.basename(path))] = measure(lambda: dehazer(image), iters, warmup=0)
+    return results
+
+
+def main():
+    args = parser.parse_args()
+    images = sorted(glob.glob(args.images))
+    torch.manual_seed(0)
+    model = TD_base().eval()
+    model.set_task(5)
+
+    results = {}
+    start = time.time()
+    if 'modules' in args.only:
+        results.update(bench_modules(model, args.batch_sizes, args.iters))
+    if 'model' in args.only:
+        results.update(bench_model(model, args.batch_sizes, args.threads or [torch.get_num_threads()], args.iters))
+    if 'data' in args.only:
+        results.update(bench_data(args.data, images, args.iters))
+    if 'e2e' in args.only:
+        results.update(bench_e2e(model, images, max(args.iters // 2, 1)))
+
+    for name, r in results.items():
+        print('{:<40}\t{:.2f} ms\t{:.1f} items/sec'.format(name, r['seconds'] * 1000, r['items_per_sec']))
+    report = {
+        'meta': {'torch': torch.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+                 'processor': platform.processor(), 'threads': torch.get_num_threads(), 'time': time.time(),
+                 'seconds': time.time() - start},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("=> wrote {} results to '{}'".format(len(results), args.output))
+
+
+if __name__ == '__main__':
+    main()
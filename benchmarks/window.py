@@ -0,0 +1,51 @@
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from TD_multi import TD_base
+from benchmarks.memory import peak_rss
+from benchmarks.suite import measure
+
+parser = argparse.ArgumentParser(description='Latency and memory of shifted window against global attention '
+                                             'as the input resolution grows, on CPU')
+parser.add_argument('-s', '--sizes', default=[48, 96, 192], type=int, nargs='+', metavar='N',
+                    help='N x N inputs, multiples of 4 (default: 48 96 192)')
+parser.add_argument('-b', '--batch-size', default=1, type=int, metavar='N', help='images per forward (default: 1)')
+parser.add_argument('--iters', default=3, type=int, metavar='N', help='timed forwards (default: 3)')
+
+
+def measure_attention(window, size, batch_size, iters):
+    """ Median forward time and peak RSS growth over the model of one attention mode, in a
+    fresh process. Global attention interpolates the embeddings to the input.
+    """
+    torch.manual_seed(0)
+    model = TD_base().eval()
+    if window:
+        model.set_window_attention(True)
+    else:
+        model.set_interpolate_embeddings(True)
+    x = torch.randn(batch_size, 3, size, size)
+    base = peak_rss()
+    with torch.no_grad():
+        r = measure(lambda: model(x), iters, items=batch_size)
+    return {'seconds': r['seconds'], 'peak_mb': (peak_rss() - base) / 2 ** 20}
+
+
+def main():
+    args = parser.parse_args()
+    for size in args.sizes:
+        results = {}
+        for name, window in (('global', False), ('window', True)):
+            # one process per run, ru_maxrss never goes down
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                results[name] = pool.submit(measure_attention, window, size, args.batch_size, args.iters).result()
+        g, w = results['global'], results['window']
+        print('{0}x{0}\t{1} tokens\tglobal {2:.3f}s {3:8.1f} MB\twindow {4:.3f}s {5:8.1f} MB\t'
+              'speedup {6:.2f}x'.format(size, (size // 4) ** 2, g['seconds'], g['peak_mb'],
+                                        w['seconds'], w['peak_mb'], g['seconds'] / w['seconds']))
+
+
+if __name__ == '__main__':
+    main()
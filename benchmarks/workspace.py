@@ -0,0 +1,41 @@
+import argparse
+
+import torch
+
+from dehaze import load_model
+from profiling import large_allocations
+from benchmarks.suite import measure
+
+parser = argparse.ArgumentParser(description='Allocations and latency of inference forwards with and without '
+                                             'the model workspace, on CPU')
+parser.add_argument('--resume', default='', type=str, metavar='PATH',
+                    help='checkpoint saved by save_checkpoint (default: random weights)')
+parser.add_argument('-b', '--batch-sizes', default=[1, 16], type=int, nargs='+', metavar='N',
+                    help='48x48 tiles per forward (default: 1 16)')
+parser.add_argument('--iters', default=5, type=int, metavar='N', help='timed forwards (default: 5)')
+parser.add_argument('--min-kb', default=1024, type=int, metavar='KB',
+                    help='allocations from this size on count as large (default: 1024)')
+
+
+def main():
+    args = parser.parse_args()
+    model = load_model(args.resume)
+    for b in args.batch_sizes:
+        x = torch.randn(b, 3, 48, 48)
+        for enabled in (False, True):
+            model.set_workspace(enabled)
+            with torch.no_grad():
+                # the first forward fills the workspace and the folded biases
+                model(x)
+                allocations = large_allocations(lambda: model(x), args.min_kb * 1024)
+                counts = model.workspace.counts if enabled else None
+                r = measure(lambda: model(x), args.iters, items=b)
+            print('batch {}\tworkspace {:<3}\t{:.2f} ms\t{} large allocations ({:.1f} MB)\t{}'.format(
+                b, 'on' if enabled else 'off', r['seconds'] * 1000, len(allocations),
+                sum(n for _, n in allocations) / 2 ** 20,
+                'steady state workspace allocations {allocations}, reuses {reuses}'.format(**counts)
+                if counts else ''))
+
+
+if __name__ == '__main__':
+    main()
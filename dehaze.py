@@ -0,0 +1,225 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from PIL import Image
+import torchvision.transforms.functional as TF
+
+from TD_multi import TD_base, TD_single
+from backends import OnnxBackend
+from haze_data import IMAGE_EXTENSIONS
+from quantize import load_quantized, quantize_model
+from tiling import TiledDehazer
+
+
+parser = argparse.ArgumentParser(description='TransDehaze CPU inference')
+parser.add_argument('inputs', nargs='+', metavar='PATH',
+                    help='hazy images, glob patterns or directories')
+parser.add_argument('-o', '--output', metavar='DIR', default='./dehazed',
+                    help='directory for the dehazed images')
+parser.add_argument('--resume', default='', type=str, metavar='PATH',
+                    help='checkpoint saved by save_checkpoint, or a .onnx file with --backend onnx')
+parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'],
+                    help='run the model with PyTorch or with ONNX Runtime (default: torch)')
+parser.add_argument('-j', '--workers', default=0, type=int, metavar='N',
+                    help='number of worker processes, 0 runs in this process (default: 0)')
+parser.add_argument('--threads', default=None, type=int, metavar='N',
+                    help='torch or onnxruntime threads per worker (default: cores / workers)')
+parser.add_argument('-b', '--batch-size', default=64, type=int, metavar='N',
+                    help='48x48 tiles per forward (default: 64)')
+parser.add_argument('--overlap', default=16, type=int, help='tile overlap in pixels')
+parser.add_argument('--tile-size', default=48, type=int, metavar='N',
+                    help='tile size in pixels, a multiple of 4; above 48 the pos and task embeddings '
+                         'are interpolated, fewer larger tiles for more memory (default: 48)')
+parser.add_argument('--window-attention', action='store_true',
+                    help='with --tile-size above 48, attend within shifted 48x48 windows instead of '
+                         'interpolating the embeddings, linear in the tile area')
+parser.add_argument('--window', default='hann', choices=['hann', 'linear', 'none'],
+                    help='blend window for overlapping tiles')
+parser.add_argument('--no-normalize', dest='normalize', action='store_false',
+                    help='feed [0, 1] images (transdehaze.py training) instead of [-1, 1] (main.py)')
+parser.add_argument('--workspace', action='store_true',
+                    help='reuse the intermediate tensors of the torch model across chunks of the same size')
+parser.add_argument('--int8', action='store_true',
+                    help='dynamically quantize the transformer linears to int8')
+parser.add_argument('--bf16', action='store_true',
+                    help='run the model under bfloat16 autocast, LayerNorm and softmax stay in float32')
+parser.add_argument('--report', default='', type=str, metavar='PATH',
+                    help='write the per-image latency report as json')
+
+
+def load_model(checkpoint='', device='cpu', int8=False):
+    """ TD_base in eval mode, optionally with the weights of a save_checkpoint() or
+    save_quantized() file, or TD_single for a checkpoint slimmed by slim.py.
+    int8 quantizes the linears of a fp32 checkpoint on load.
+    """
+    state = torch.load(checkpoint, map_location='cpu', weights_only=False) if checkpoint else {}
+    # slimmed checkpoints never allocate the heads and tails of the other tasks
+    model = TD_single(state['single_task']) if 'single_task' in state else TD_base()
+    if 'quantization' in state:
+        return load_quantized(model, state).eval()
+    if state:
+        state_dict = state.get('state_dict', state)
+        # checkpoints saved from a DataParallel wrapper carry a module. prefix
+        state_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()}
+        model.load_state_dict(state_dict)
+    if int8:
+        # quantized kernels only run on CPU
+        return quantize_model(model)
+    # the embeddings are constant at inference, add their projections as biases
+    model.set_fold_embeddings(True)
+    return model.to(device).eval()
+
+
+def load_backend(checkpoint='', backend='torch', device='cpu', int8=False, threads=None):
+    """ Model for TiledDehazer: load_model() for torch, an OnnxBackend of an exported .onnx file for onnx """
+    if backend == 'onnx':
+        if int8:
+            raise ValueError("int8 quantization is only available with the torch backend")
+        return OnnxBackend(checkpoint, threads)
+    return load_model(checkpoint, device, int8)
+
+
+def collect_images(inputs):
+    """ Expand files, glob patterns and directories into a sorted list of image paths """
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths += sorted(os.path.join(item, f) for f in os.listdir(item)
+                            if f.lower().endswith(IMAGE_EXTENSIONS))
+        elif glob.has_magic(item):
+            paths += sorted(f for f in glob.glob(item) if f.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths.append(item)
+    return paths
+
+
+class Dehazer(object):
+    """ PIL image in, dehazed PIL image out, any resolution """
+
+    def __init__(self, model, batch_size=64, overlap=16, window='hann', normalize=True, device='cpu', dtype=None,
+                 tile_size=48, window_attention=False, workspace=False):
+        self.normalize = normalize
+        if workspace:
+            if not hasattr(model, 'set_workspace'):
+                raise ValueError("the workspace needs the torch backend")
+            model.set_workspace(True)
+        if tile_size != 48:
+            if not hasattr(model, 'set_interpolate_embeddings'):
+                raise ValueError("tiles other than 48x48 need the torch backend")
+            if window_attention:
+                model.set_window_attention(True)
+            else:
+                model.set_interpolate_embeddings(True)
+        self.tiler = TiledDehazer(model, tile_size=tile_size, overlap=overlap, batch_size=batch_size, window=window,
+                                  device=device, dtype=dtype)
+
+    def __call__(self, image):
+        x = TF.to_tensor(image.convert('RGB'))
+        if self.normalize:
+            x = x * 2 - 1
+        out = self.tiler(x)
+        if self.normalize:
+            out = out * 0.5 + 0.5
+        return TF.to_pil_image(out.clamp(0, 1).cpu())
+
+
+_dehazer = None
+
+
+def _init_worker(checkpoint, backend, threads, int8, kwargs):
+    global _dehazer
+    if threads:
+        torch.set_num_threads(threads)
+    _dehazer = Dehazer(load_backend(checkpoint, backend, int8=int8, threads=threads), **kwargs)
+
+
+def output_paths(paths, output_dir):
+    """ Where each of paths is saved in output_dir: at its path relative to the deepest
+    directory holding all of them, so inputs of different directories with the same
+    file name do not overwrite each other
+    """
+    paths = [os.path.abspath(path) for path in paths]
+    root = os.path.commonpath([os.path.dirname(path) for path in paths]) if paths else ''
+    return [os.path.join(output_dir, os.path.relpath(path, root)) for path in paths]
+
+
+def _dehaze_file(path, out_path):
+    start = time.time()
+    out = _dehazer(Image.open(path))
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    out.save(out_path)
+    return {'input': path, 'output': out_path, 'size': list(out.size),
+            'tiles': _dehazer.tiler.stats.tiles, 'latency': time.time() - start}
+
+
+def dehaze_files(paths, output_dir, checkpoint='', backend='torch', workers=0, threads=None, int8=False, **kwargs):
+    """ Dehaze every image in paths into output_dir, see output_paths, and return one
+    report entry per image.
+    kwargs are passed on to Dehazer (batch_size, overlap, window, normalize, dtype, tile_size,
+    window_attention, workspace).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    out_paths = output_paths(paths, output_dir)
+    if workers <= 0:
+        _init_worker(checkpoint, backend, threads, int8, kwargs)
+        return [_dehaze_file(path, out_path) for path, out_path in zip(paths, out_paths)]
+
+    threads = threads or max(torch.get_num_threads() // workers, 1)
+    # spawn so workers don't inherit the parent's intra-op thread pool
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(checkpoint, backend, threads, int8, kwargs)) as pool:
+        return list(pool.map(_dehaze_file, paths, out_paths))
+
+
+def summarize(results, seconds):
+    latencies = sorted(r['latency'] for r in results)
+    n = len(latencies)
+    return {
+        'images': n,
+        'seconds': seconds,
+        'images_per_sec': n / seconds if seconds > 0 else 0.,
+        'tiles_per_sec': sum(r['tiles'] for r in results) / seconds if seconds > 0 else 0.,
+        'latency_mean': sum(latencies) / n if n else 0.,
+        'latency_p50': latencies[n // 2] if n else 0.,
+        'latency_max': latencies[-1] if n else 0.,
+    }
+
+
+def main():
+    args = parser.parse_args()
+    if args.tile_size <= 0 or args.tile_size % 4:
+        parser.error("--tile-size must be a positive multiple of 4, got {}".format(args.tile_size))
+
+    paths = collect_images(args.inputs)
+    if not paths:
+        raise RuntimeError("no images found in {}".format(args.inputs))
+    print("=> dehazing {} images with {} workers on {}".format(len(paths), args.workers, args.backend))
+
+    start = time.time()
+    results = dehaze_files(paths, args.output, checkpoint=args.resume, backend=args.backend,
+                           workers=args.workers, threads=args.threads, int8=args.int8,
+                           batch_size=args.batch_size, overlap=args.overlap, window=args.window,
+                           normalize=args.normalize, tile_size=args.tile_size,
+                           window_attention=args.window_attention, workspace=args.workspace,
+                           dtype=torch.bfloat16 if args.bf16 else None)
+    summary = summarize(results, time.time() - start)
+
+    for r in results:
+        print('{input}\t{size[0]}x{size[1]}\t{tiles} tiles\t{latency:.3f}s'.format(**r))
+    print(' * {images} images in {seconds:.2f}s\t{images_per_sec:.2f} images/sec\t'
+          '{tiles_per_sec:.1f} tiles/sec\tLatency mean {latency_mean:.3f}s '
+          'p50 {latency_p50:.3f}s max {latency_max:.3f}s'.format(**summary))
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'summary': summary, 'images': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import time
+
+import torch
+
+from TD_multi import SingleTaskTransformer
+from backends import OnnxBackend
+
+parser = argparse.ArgumentParser(description='Export TransDehaze to TorchScript and ONNX for low latency serving')
+parser.add_argument('--resume', default='', type=str, metavar='PATH',
+                    help='checkpoint saved by save_checkpoint')
+parser.add_argument('-o', '--output', default='td_dehaze.pt', type=str, metavar='PATH',
+                    help='where to save the frozen TorchScript module')
+parser.add_argument('--onnx', default='', type=str, metavar='PATH',
+                    help='also export to ONNX with a dynamic batch axis, validated against PyTorch with onnxruntime')
+parser.add_argument('--atol', default=1e-4, type=float, help='max abs difference allowed between onnxruntime and PyTorch')
+parser.add_argument('--task', default=5, type=int, help='task to specialize for (default: 5, dehaze)')
+parser.add_argument('--compile', action='store_true',
+                    help='also benchmark torch.compile of the specialized module')
+parser.add_argument('--batch-sizes', default=[1, 16], type=int, nargs='+', metavar='N',
+                    help='batch sizes to benchmark (default: 1 16)')
+parser.add_argument('--iters', default=10, type=int, metavar='N', help='timed iterations per setting')
+parser.add_argument('--threads', default=None, type=int, nargs='+', metavar='N',
+                    help='intra-op thread counts to benchmark with (default: torch.get_num_threads())')
+
+
+def specialize(model, task_id=5):
+    """ model as a SingleTaskTransformer of task_id in eval mode """
+    if not isinstance(model, SingleTaskTransformer):
+        model = SingleTaskTransformer(model, task_id)
+    return model.eval()
+
+
+def export_torchscript(model, path='', task_id=5, batch_size=1):
+    """ Trace the task_id path of model into a frozen TorchScript module for 48x48 inputs.
+    The batch dimension stays dynamic.
+    """
+    net = specialize(model, task_id)
+    example = torch.randn(batch_size, 3, 48, 48)
+    with torch.no_grad():
+        traced = torch.jit.trace(net, example, check_trace=False)
+        frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    if path:
+        frozen.save(path)
+    return frozen
+
+
+def compile_model(model, task_id=5, **kwargs):
+    """ torch.compile of the task_id path of model, kwargs go to torch.compile """
+    return torch.compile(specialize(model, task_id), **kwargs)
+
+
+def export_onnx(model, path, task_id=5, opset=17):
+    """ Export the task_id path of model to ONNX for 48x48 inputs, with a dynamic batch axis """
+    net = specialize(model, task_id)
+    with torch.no_grad():
+        # the TorchScript based exporter, the dynamo one needs onnxscript
+        torch.onnx.export(net, (torch.randn(1, 3, 48, 48),), path, input_names=['hazy'], output_names=['dehazed'],
+                          dynamic_axes={'hazy': {0: 'batch'}, 'dehazed': {0: 'batch'}},
+                          opset_version=opset, dynamo=False)
+    return path
+
+
+def validate_onnx(model, path, batch_sizes=(1, 4), atol=1e-4):
+    """ Max abs difference between onnxruntime and model over random batches, raises above atol """
+    session = OnnxBackend(path)
+    diff = 0.
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, 3, 48, 48)
+        with torch.no_grad():
+            diff = max(diff, (session(x) - model(x)).abs().max().item())
+    if diff > atol:
+        raise RuntimeError("onnxruntime output of {} differs from PyTorch by {:.2e} > {:.0e}".format(path, diff, atol))
+    return diff
+
+
+def benchmark(fn, x, iters=10, warmup=2):
+    """ Mean latency in seconds of fn(x) """
+    with torch.inference_mode():
+        for _ in range(warmup):
+            fn(x)
+        start = time.perf_counter()
+        for _ in range(iters):
+            fn(x)
+    return (time.perf_counter() - start) / iters
+
+
+def main():
+    # dehaze.py is the inference entry point, only borrow its checkpoint loading
+    from dehaze import load_model
+
+    args = parser.parse_args()
+
+    model = load_model(args.resume)
+    if hasattr(model, 'set_task'):
+        model.set_task(args.task)
+    scripted = export_torchscript(model, args.output, args.task)
+    print("=> saved frozen TorchScript module to '{}'".format(args.output))
+    if args.onnx:
+        export_onnx(model, args.onnx, args.task)
+        print("=> saved ONNX model to '{}', onnxruntime max diff {:.2e}".format(
+            args.onnx, validate_onnx(model, args.onnx, atol=args.atol)))
+    compiled = compile_model(model, args.task) if args.compile else None
+
+    for threads in args.threads or [torch.get_num_threads()]:
+        torch.set_num_threads(threads)
+        backends = [('eager', model), ('torchscript', scripted)]
+        if compiled is not None:
+            backends.append(('compile', compiled))
+        if args.onnx:
+            backends.append(('onnxruntime', OnnxBackend(args.onnx, threads)))
+
+        for batch_size in args.batch_sizes:
+            x = torch.randn(batch_size, 3, 48, 48)
+            with torch.inference_mode():
+                ref = model(x)
+            eager = None
+            for name, fn in backends:
+                with torch.inference_mode():
+                    diff = (fn(x) - ref).abs().max().item()
+                latency = benchmark(fn, x, args.iters)
+                eager = eager or latency
+                print('threads {}\tbatch {}\t{:<12}\tlatency {:.2f} ms\t{:.1f} img/s\tspeedup {:.2f}x\t'
+                      'max diff {:.2e}'.format(threads, batch_size, name, latency * 1000, batch_size / latency,
+                                               eager / latency, diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from TD_multi import SingleTaskTransformer
+from tiling import TileStats, TiledDehazer, blend_window, tile_starts
+
+
+def conv_radius(module):
+    """ Receptive radius of a chain of stride 1 convolutions """
+    return sum((m.kernel_size[0] - 1) // 2 for m in module.modules() if isinstance(m, nn.Conv2d))
+
+
+def conv_flops_per_pixel(module):
+    """ FLOPs of the stride 1 convolutions of module for one output pixel """
+    return sum(2 * m.out_channels * m.in_channels // m.groups * m.kernel_size[0] * m.kernel_size[1]
+               for m in module.modules() if isinstance(m, nn.Conv2d))
+
+
+def run_in_bands(fn, x, rows, halo):
+    """ fn over x (N C H W) in bands of rows output rows, each computed from the band
+    plus halo rows of context on both sides, so the result equals fn(x) for any fn made
+    of stride 1 convolutions with a receptive radius up to halo.
+    Returns the stitched output and the number of input rows fn ran over.
+    """
+    H = x.shape[-2]
+    outs, computed = [], 0
+    for top in range(0, H, rows):
+        bottom = min(top + rows, H)
+        lo, hi = max(top - halo, 0), min(bottom + halo, H)
+        out = fn(x[:, :, lo:hi])
+        computed += hi - lo
+        outs.append([o[:, :, top - lo:top - lo + bottom - top] for o in out] if isinstance(out, tuple)
+                    else out[:, :, top - lo:top - lo + bottom - top])
+    if isinstance(outs[0], list):
+        return tuple(torch.cat(o, dim=2) for o in zip(*outs)), computed
+    return torch.cat(outs, dim=2), computed
+
+
+def crop_windows(feat, coords, size):
+    """ size x size windows of feat at coords, stacked tile by tile along the batch """
+    return torch.cat([feat[:, :, top:top + size, left:left + size] for top, left in coords])
+
+
+class FullFrameDehazer(object):
+    """ Tiled inference that runs the convolutions over the whole frame.
+    The three Head stacks see the full image once, in bands of band_rows rows, instead
+    of every overlapping tile again with zero padding at the tile borders. Their
+    features are cut into tile_size windows for the transformer and the channel
+    attention fusion, the fused windows are blended into a full frame feature map
+    and the Tail runs once over it.
+    Called like TiledDehazer: C H W or N C H W in, same shape out.
+    """
+
+    def __init__(self, model, tile_size=48, overlap=16, batch_size=64, window='hann', band_rows=96, task_id=5,
+                 device=None):
+        if not 0 <= overlap < tile_size:
+            raise ValueError("overlap must be in [0, tile_size)")
+        if not isinstance(model, SingleTaskTransformer):
+            model = SingleTaskTransformer(model, task_id)
+        self.model = model.eval()
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.band_rows = band_rows
+        self.device = torch.device(device) if device is not None else next(model.parameters()).device
+        self.weight = blend_window(tile_size, overlap, window).to(self.device)
+        self.head_halo = conv_radius(nn.ModuleList([model.head, model.head2, model.head3]))
+        self.tail_halo = conv_radius(model.tail)
+        self.stats = TileStats()
+        self.flops = {}
+
+    def tiles(self, H, W):
+        stride = self.tile_size - self.overlap
+        return [(top, left) for top in tile_starts(H, self.tile_size, stride)
+                for left in tile_starts(W, self.tile_size, stride)]
+
+    def conv_flops(self, H, W, head_rows=None):
+        """ Head and Tail convolution FLOPs of naive tiling and of this engine for an H x W image """
+        heads = conv_flops_per_pixel(nn.ModuleList([self.model.head, self.model.head2, self.model.head3]))
+        tail = conv_flops_per_pixel(self.model.tail)
+        t = self.tile_size
+        Hp, Wp = max(H, t), max(W, t)
+        naive = len(self.tiles(Hp, Wp)) * t * t * (heads + tail)
+        full = (head_rows if head_rows is not None else Hp) * Wp * heads + Hp * Wp * tail
+        return {'naive': naive, 'full_frame': full, 'saved': 1 - full / naive}
+
+    @torch.no_grad()
+    def __call__(self, image):
+        squeeze = image.dim() == 3
+        if squeeze:
+            image = image[None]
+        N, C, H, W = image.shape
+        t = self.tile_size
+        pad_h, pad_w = max(t - H, 0), max(t - W, 0)
+        if pad_h or pad_w:
+            image = torch.nn.functional.pad(image, (0, pad_w, 0, pad_h), mode='replicate')
+        image = image.to(self.device)
+        Hp, Wp = image.shape[-2:]
+
+        start = time.time()
+        (x, x2, x3), head_rows = run_in_bands(self.model.heads, image, self.band_rows, self.head_halo)
+        fused = torch.zeros((N, x.shape[1], Hp, Wp), device=self.device)
+        norm = torch.zeros((1, 1, Hp, Wp), device=self.device)
+        coords = self.tiles(Hp, Wp)
+        per_chunk = max(self.batch_size // N, 1)
+        for c in range(0, len(coords), per_chunk):
+            chunk = coords[c:c + per_chunk]
+            out = self.model.body(*[crop_windows(feat, chunk, t) for feat in (x, x2, x3)])
+            out = out.view(len(chunk), N, *out.shape[1:]) * self.weight
+            for k, (top, left) in enumerate(chunk):
+                fused[:, :, top:top + t, left:left + t] += out[k]
+                norm[:, :, top:top + t, left:left + t] += self.weight
+        out, _ = run_in_bands(self.model.tail, fused / norm, self.band_rows, self.tail_halo)
+        self.stats = TileStats(len(coords) * N, time.time() - start)
+        self.flops = self.conv_flops(H, W, head_rows)
+
+        out = out.float()[:, :, :H, :W]
+        return out[0] if squeeze else out
+
+
+def check_heads(dehazer, image, tiles=4):
+    """ Max difference between full frame Head features and the Heads run on single
+    tiles with a receptive radius halo of real context around them
+    """
+    t, halo = dehazer.tile_size, dehazer.head_halo
+    model = dehazer.model
+    with torch.no_grad():
+        full, _ = run_in_bands(model.heads, image[None], dehazer.band_rows, halo)
+        H, W = image.shape[-2:]
+        diff = 0.
+        for top, left in dehazer.tiles(H, W)[:tiles]:
+            lo_h, lo_w = max(top - halo, 0), max(left - halo, 0)
+            window = image[None, :, lo_h:top + t + halo, lo_w:left + t + halo]
+            for f, w in zip(full, model.heads(window)):
+                w = w[:, :, top - lo_h:top - lo_h + t, left - lo_w:left - lo_w + t]
+                diff = max(diff, (f[:, :, top:top + t, left:left + t] - w).abs().max().item())
+    return diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Full frame convolution stem against naive tiled inference')
+    parser.add_argument('image', help='hazy input image')
+    parser.add_argument('-o', '--output', default='', help='save the full frame result here')
+    parser.add_argument('--resume', default='', type=str, metavar='PATH',
+                        help='checkpoint saved by save_checkpoint or slim.py')
+    parser.add_argument('-b', '--batch-size', default=64, type=int, help='tiles per forward')
+    parser.add_argument('--overlap', default=16, type=int, help='tile overlap in pixels')
+    parser.add_argument('--band-rows', default=96, type=int, help='image rows per Head band')
+    args = parser.parse_args()
+
+    from PIL import Image
+    import torchvision.transforms.functional as TF
+    from dehaze import load_model
+    from quantize import psnr
+
+    model = load_model(args.resume)
+    image = TF.to_tensor(Image.open(args.image).convert('RGB')) * 2 - 1
+    naive = TiledDehazer(model, overlap=args.overlap, batch_size=args.batch_size)
+    full = FullFrameDehazer(model, overlap=args.overlap, batch_size=args.batch_size, band_rows=args.band_rows)
+
+    ref = naive(image)
+    out = full(image)
+    print('naive\t{:.2f}s\nfull frame\t{:.2f}s\tspeedup {:.2f}x'.format(
+        naive.stats.seconds, full.stats.seconds, naive.stats.seconds / full.stats.seconds))
+    print('conv GFLOPs naive {:.2f}\tfull frame {:.2f}\tsaved {:.1%}'.format(
+        full.flops['naive'] / 1e9, full.flops['full_frame'] / 1e9, full.flops['saved']))
+    print('PSNR full frame vs naive {:.2f}\tHead features vs haloed tiles max diff {:.2e}'.format(
+        psnr(out, ref), check_heads(full, image)))
+    if args.output:
+        TF.to_pil_image((out * 0.5 + 0.5).clamp(0, 1)).save(args.output)
+
+
+if __name__ == '__main__':
+    main()
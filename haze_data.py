@@ -0,0 +1,160 @@
+import argparse
+import os
+import time
+
+import torch
+import torch.utils.data as DT
+import torchvision.transforms as transforms
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+
+def file_stem(name):
+    return os.path.splitext(name)[0]
+
+
+def index_pairs(hazy_dir, clear_dir, key=file_stem):
+    """ Pair hazy and clear images whose file names map to the same key.
+    Pairing by name does not depend on the order os.listdir returns files in.
+    """
+    def listing(path):
+        return {key(f): f for f in sorted(os.listdir(path)) if f.lower().endswith(IMAGE_EXTENSIONS)}
+
+    hazy, clear = listing(hazy_dir), listing(clear_dir)
+    missing = sorted(set(hazy) - set(clear))
+    if missing:
+        raise RuntimeError("{} hazy images have no reference in {}, e.g. {}".format(
+            len(missing), clear_dir, hazy[missing[0]]))
+    return [(os.path.join(hazy_dir, hazy[k]), os.path.join(clear_dir, clear[k])) for k in sorted(hazy)]
+
+
+def random_crop_pair(hazy, clear, size):
+    """ Same random size x size window out of both C H W images """
+    H, W = hazy.shape[-2:]
+    top = torch.randint(0, H - size + 1, ()).item() if H > size else 0
+    left = torch.randint(0, W - size + 1, ()).item() if W > size else 0
+    return hazy[:, top:top + size, left:left + size], clear[:, top:top + size, left:left + size]
+
+
+class PairedHazeDataset(DT.Dataset):
+    """ Hazy/clear image pairs decoded lazily in __getitem__.
+    root holds an input/ folder of hazy images and a ref/ folder of clear ones,
+    only the file list is read on construction.
+    """
+
+    def __init__(self, root, transform=None, crop_size=None, hazy='input', clear='ref', key=file_stem):
+        super(PairedHazeDataset, self).__init__()
+        self.pairs = index_pairs(os.path.join(root, hazy), os.path.join(root, clear), key)
+        self.transform = transform or transforms.ToTensor()
+        self.crop_size = crop_size
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def load(self, path):
+        with Image.open(path) as image:
+            return self.transform(image.convert('RGB'))
+
+    def __getitem__(self, idx):
+        hazy_path, clear_path = self.pairs[idx]
+        hazy, clear = self.load(hazy_path), self.load(clear_path)
+        if self.crop_size:
+            hazy, clear = random_crop_pair(hazy, clear, self.crop_size)
+        return hazy, clear
+
+
+def sample_crops(hazy, clear, size, count):
+    """ count aligned random size x size crops out of a C H W pair, gathered with one indexing op """
+    pair = torch.cat([hazy, clear])
+    H, W = pair.shape[-2:]
+    size_h, size_w = min(size, H), min(size, W)
+    tops = torch.randint(0, H - size_h + 1, (count, 1))
+    lefts = torch.randint(0, W - size_w + 1, (count, 1))
+    rows = tops + torch.arange(size_h)
+    cols = lefts + torch.arange(size_w)
+    return pair[:, rows[:, :, None], cols[:, None, :]].transpose(0, 1)
+
+
+def augment_crops(crops):
+    """ Random flip and rot90 per crop; hazy and clear share channels so they stay aligned """
+    N = crops.shape[0]
+    flip = torch.rand(N) < 0.5
+    crops[flip] = crops[flip].flip(-1)
+    if crops.shape[-1] == crops.shape[-2]:
+        k = torch.randint(0, 4, (N,))
+        for r in range(1, 4):
+            crops[k == r] = crops[k == r].rot90(r, (-2, -1))
+    return crops
+
+
+class PairedCropSampler(DT.Dataset):
+    """ crops_per_image aligned, augmented crops out of every decoded pair.
+    Wraps a dataset returning whole C H W pairs, so one decode feeds many
+    training samples. Use collate_crops to merge them into flat batches.
+    """
+
+    def __init__(self, dataset, crops_per_image=16, crop_size=48, augment=True):
+        super(PairedCropSampler, self).__init__()
+        self.dataset = dataset
+        self.crops_per_image = crops_per_image
+        self.crop_size = crop_size
+        self.augment = augment
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        hazy, clear = self.dataset[idx]
+        crops = sample_crops(hazy, clear, self.crop_size, self.crops_per_image)
+        if self.augment:
+            crops = augment_crops(crops)
+        C = hazy.shape[0]
+        return crops[:, :C], crops[:, C:]
+
+
+def collate_crops(batch):
+    hazy, clear = zip(*batch)
+    return torch.cat(hazy), torch.cat(clear)
+
+
+def make_loader(dataset, batch_size, workers=0, prefetch=2, shuffle=False, sampler=None, **kwargs):
+    """ DataLoader decoding in worker processes, each keeping prefetch batches in flight """
+    if workers > 0:
+        kwargs.update(prefetch_factor=prefetch, persistent_workers=True)
+    return DT.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle and sampler is None,
+                         sampler=sampler, num_workers=workers, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the paired crop pipeline throughput')
+    parser.add_argument('data', metavar='DIR', help='dataset with hazy images in input/ and references in ref/, '
+                                                     'or a shard packed by haze_shard.py')
+    parser.add_argument('-b', '--batch-size', default=256, type=int, metavar='N', help='samples per batch')
+    parser.add_argument('-j', '--workers', default=4, type=int, metavar='N')
+    parser.add_argument('--prefetch', default=2, type=int, metavar='N')
+    parser.add_argument('--crops-per-image', default=16, type=int, metavar='N')
+    parser.add_argument('--crop-size', default=48, type=int, metavar='N')
+    parser.add_argument('--epochs', default=1, type=int, metavar='N')
+    args = parser.parse_args()
+
+    if os.path.isfile(args.data):
+        from haze_shard import ShardDataset
+        dataset = ShardDataset(args.data, crop_size=None)
+    else:
+        dataset = PairedHazeDataset(args.data)
+    dataset = PairedCropSampler(dataset, args.crops_per_image, args.crop_size)
+    loader = make_loader(dataset, max(args.batch_size // args.crops_per_image, 1), workers=args.workers,
+                         prefetch=args.prefetch, shuffle=True, collate_fn=collate_crops)
+
+    samples = 0
+    start = time.time()
+    for _ in range(args.epochs):
+        for hazy, clear in loader:
+            samples += hazy.shape[0]
+    seconds = time.time() - start
+    print("{} samples in {:.2f}s, {:.1f} samples/sec".format(samples, seconds, samples / seconds))
+
+
+if __name__ == '__main__':
+    main()
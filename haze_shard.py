@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+import torch.utils.data as DT
+from PIL import Image
+
+from haze_data import index_pairs, random_crop_pair
+
+
+def index_path(path):
+    return path + '.json'
+
+
+def pack_shard(pairs, path):
+    """ Decode (hazy, clear) image path pairs once into a raw uint8 shard.
+    Images are stored back to back as H W C bytes in path, their offsets and
+    shapes go to path.json.
+    """
+    index = []
+    offset = 0
+    with open(path, 'wb') as f:
+        for hazy_path, clear_path in pairs:
+            entry = {'name': os.path.basename(hazy_path)}
+            for key, image_path in (('hazy', hazy_path), ('clear', clear_path)):
+                with Image.open(image_path) as image:
+                    data = np.asarray(image.convert('RGB'), dtype=np.uint8)
+                f.write(data.tobytes())
+                entry[key] = [offset, *data.shape]
+                offset += data.nbytes
+            if entry['hazy'][1:] != entry['clear'][1:]:
+                raise RuntimeError("{} and {} differ in size".format(hazy_path, clear_path))
+            index.append(entry)
+    with open(index_path(path), 'w') as f:
+        json.dump({'size': offset, 'images': index}, f)
+    return index
+
+
+class ShardDataset(DT.Dataset):
+    """ Hazy/clear pairs served straight from a memory-mapped shard.
+    The file is mapped lazily in each DataLoader worker, so all workers read
+    the same page cache, and crops are views into the mapping until they are
+    converted to float.
+    """
+
+    def __init__(self, path, crop_size=48):
+        super(ShardDataset, self).__init__()
+        self.path = path
+        with open(index_path(path)) as f:
+            self.index = json.load(f)['images']
+        self.crop_size = crop_size
+        self.data = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # never pickle the mapping into the workers, each one maps the file itself
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def view(self, offset, H, W, C):
+        return self.data[offset:offset + H * W * C].view(H, W, C)
+
+    def __getitem__(self, idx):
+        if self.data is None:
+            # copy-on-write mapping gives writable, zero-copy tensors without touching the file
+            self.data = torch.from_numpy(np.memmap(self.path, dtype=np.uint8, mode='c'))
+        entry = self.index[idx]
+        hazy, clear = self.view(*entry['hazy']), self.view(*entry['clear'])
+        # same C H W layout as transforms.ToTensor, still views into the shard
+        hazy, clear = hazy.permute(2, 0, 1), clear.permute(2, 0, 1)
+        if self.crop_size:
+            hazy, clear = random_crop_pair(hazy, clear, self.crop_size)
+        return hazy.float().div_(255), clear.float().div_(255)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack hazy/clear image pairs into a memory-mapped shard')
+    parser.add_argument('data', metavar='DIR', help='dataset with hazy images in input/ and references in ref/')
+    parser.add_argument('output', metavar='PATH', help='shard file, the index is written next to it as .json')
+    args = parser.parse_args()
+
+    pairs = index_pairs(os.path.join(args.data, 'input'), os.path.join(args.data, 'ref'))
+    index = pack_shard(pairs, args.output)
+    print("=> packed {} pairs into '{}' ({:.1f} MB)".format(
+        len(index), args.output, os.path.getsize(args.output) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+import json
+import time
+
+from server import parser as server_parser, build_server, percentile
+
+parser = argparse.ArgumentParser(description='Localhost load generator for server.py', parents=[server_parser],
+                                 conflict_handler='resolve')
+parser.add_argument('images', nargs='+', metavar='PATH', help='images sent round robin as request bodies')
+parser.add_argument('-c', '--concurrency', default=8, type=int, metavar='N',
+                    help='clients, each with one request in flight (default: 8)')
+parser.add_argument('-n', '--requests', default=64, type=int, metavar='N', help='requests in total (default: 64)')
+parser.add_argument('--local', action='store_true',
+                    help='start server.py in this process on a free port, with the server options given here')
+
+
+async def request(reader, writer, host, method, path, body=b''):
+    writer.write('{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n'.format(
+        method, path, host, len(body)).encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b'\n', b''):
+            break
+        key, value = header.decode('latin-1').split(':', 1)
+        if key.strip().lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def client(host, port, bodies, counter, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            i = next(counter, None)
+            if i is None:
+                break
+            start = time.time()
+            status, _ = await request(reader, writer, host, 'POST', '/dehaze', bodies[i % len(bodies)])
+            if status != 200:
+                raise RuntimeError("request {} failed with status {}".format(i, status))
+            latencies.append(time.time() - start)
+    finally:
+        writer.close()
+
+
+async def run(args):
+    bodies = []
+    for path in args.images:
+        with open(path, 'rb') as f:
+            bodies.append(f.read())
+
+    server = None
+    host, port = args.host, args.port
+    if args.local:
+        server = build_server(args)
+        host, port = await server.start(args.host, 0)
+
+    latencies = []
+    counter = iter(range(args.requests))
+    start = time.time()
+    await asyncio.gather(*[client(host, port, bodies, counter, latencies) for _ in range(args.concurrency)])
+    seconds = time.time() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, metrics = await request(reader, writer, host, 'GET', '/metrics')
+    writer.close()
+    if server is not None:
+        await server.stop()
+
+    print(' * {} requests with {} clients in {:.2f}s\t{:.2f} requests/sec\tLatency p50 {:.3f}s p95 {:.3f}s '
+          'p99 {:.3f}s'.format(len(latencies), args.concurrency, seconds, len(latencies) / seconds,
+                               percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99)))
+    print(' * server {}'.format(json.dumps(json.loads(metrics))))
+
+
+def main():
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,9 +7,9 @@ from datetime import datetime
 from collections import OrderedDict
 import math
 import random
+from contextlib import nullcontext
 
 import torch
-from torch.cuda.amp.autocast_mode import autocast
 import torch.nn as nn
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
@@ -23,6 +23,7 @@ import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 #import torchvision.models as models
 from TD_multi import TD_base
+from profiling import ModuleProfiler, chrome_trace
 from dataset.dataset import *
 from datetime import datetime
 
@@ -45,6 +46,9 @@ parser.add_argument('-b', '--batch-size', default=256, type=int,
                     help='mini-batch size (default: 256), this is the total '
                          'batch size of all GPUs on the current node when '
                          'using Data Parallel or Distributed Data Parallel')
+parser.add_argument('--accumulation-steps', default=1, type=int, metavar='N',
+                    help='micro-batches of -b samples whose gradients are summed per optimizer step, '
+                         'for an effective batch of N times -b (default: 1)')
 parser.add_argument('--lr', '--learning-rate', default=0.0001, type=float,
                     metavar='LR', help='initial learning rate', dest='lr')
 parser.add_argument('--lr-policy', default='naive',
@@ -79,19 +83,39 @@ parser.add_argument('--rank', default=-1, type=int,
                     help='node rank for distributed training')
 parser.add_argument('--dist-url', default='tcp://224.66.41.62:23456', type=str,
                     help='url used to set up distributed training')
-parser.add_argument('--dist-backend', default='nccl', type=str,
-                    help='distributed backend')
+parser.add_argument('--dist-backend', default=None, type=str,
+                    help='distributed backend (default: nccl with GPUs, gloo on CPU)')
 parser.add_argument('--seed', default=None, type=int,
                     help='seed for initializing training. ')
 parser.add_argument('--gpu', default=None, type=int,
                     help='GPU id to use.')
+parser.add_argument('--device', default=None, type=str,
+                    help='device to train on, e.g. cpu or cuda (default: cuda if available)')
 parser.add_argument('--multiprocessing-distributed', action='store_true',
                     help='Use multi-processing distributed training to launch '
                          'N processes per node, which has N GPUs. This is the '
                          'fastest way to use PyTorch for either single node or '
                          'multi node data parallel training')
+parser.add_argument('--procs-per-node', default=None, type=int, metavar='N',
+                    help='processes per node for CPU distributed training (default: '
+                         'LOCAL_WORLD_SIZE under torchrun, else 1 per GPU or 1)')
 parser.add_argument('--fp16',action='store_true', default=False, help="\
-                    use fp16 instead of fp32.")
+                    use fp16 instead of fp32, same as --precision fp16.")
+parser.add_argument('--precision', default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                    help='autocast precision of train and validate, bf16 also runs on CPU; '
+                         'LayerNorm, softmax, loss and PSNR stay in fp32 (default: fp32)')
+parser.add_argument('--checkpoint-activations', default=[], nargs='+', choices=['heads', 'blocks'],
+                    help='recompute the branch Head stacks and/or the transformer blocks in backward '
+                         'instead of keeping their activations, trading step time for memory')
+parser.add_argument('--profile', action='store_true',
+                    help='hook every submodule and print wall time, FLOPs and activation memory '
+                         'per module type after each epoch')
+parser.add_argument('--profile-trace', default='', type=str, metavar='PATH',
+                    help='write a torch.profiler Chrome trace of a window of training iterations')
+parser.add_argument('--profile-start', default=5, type=int, metavar='N',
+                    help='first iteration of the traced window (default: 5)')
+parser.add_argument('--profile-steps', default=3, type=int, metavar='N',
+                    help='iterations in the traced window (default: 3)')
 
 
 best_acc1 = 0
@@ -100,6 +124,8 @@ best_acc1 = 0
 
 def main():
     args = parser.parse_args()
+    if args.fp16:
+        args.precision = 'fp16'
 
     now = datetime.now()
     timestr = now.strftime("%m-%d-%H_%M_%S")
@@ -124,12 +150,27 @@ def main():
         warnings.warn('You have chosen a specific GPU. This will completely '
                       'disable data parallelism.')
 
+    # torchrun exports the rendezvous through the environment
+    if "WORLD_SIZE" in os.environ and args.world_size == -1:
+        args.dist_url = "env://"
     if args.dist_url == "env://" and args.world_size == -1:
         args.world_size = int(os.environ["WORLD_SIZE"])
 
-    args.distributed = args.world_size > 1 or args.multiprocessing_distributed
+    if args.device is None:
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    use_cuda = torch.device(args.device).type == 'cuda'
 
-    ngpus_per_node = torch.cuda.device_count()
+    args.distributed = args.world_size > 1 or args.multiprocessing_distributed
+    if args.dist_backend is None:
+        args.dist_backend = 'nccl' if use_cuda else 'gloo'
+
+    ngpus_per_node = torch.cuda.device_count() if use_cuda else 0
+    if args.procs_per_node is None:
+        args.procs_per_node = int(os.environ.get("LOCAL_WORLD_SIZE", ngpus_per_node or 1))
+    if not use_cuda or not args.multiprocessing_distributed:
+        # CPU processes: one gloo rank per process instead of one per GPU; torchrun may
+        # also start fewer GPU processes than there are GPUs, the batch is split per process
+        ngpus_per_node = args.procs_per_node
     if args.multiprocessing_distributed:
         # Since we have ngpus_per_node processes per node, the total world_size
         # needs to be adjusted accordingly
@@ -143,10 +184,24 @@ def main():
 
 
 def main_worker(gpu, ngpus_per_node, args):
-    args.gpu = gpu
+    local_rank = gpu
+    args.device = torch.device(args.device)
+    if args.device.type == 'cuda':
+        if args.gpu is None and args.distributed and "LOCAL_RANK" in os.environ:
+            # one GPU per torchrun process
+            gpu = int(os.environ["LOCAL_RANK"])
+        args.gpu = gpu
+        if args.gpu is not None:
+            args.device = torch.device('cuda', args.gpu)
+            torch.cuda.set_device(args.device)
+    else:
+        args.gpu = None
+    # pinned host memory and asynchronous copies only exist for CUDA
+    args.non_blocking = args.device.type == 'cuda'
 
     if args.gpu is not None:
         print("Use GPU: {} for training".format(args.gpu))
+    print("Use device: {}".format(args.device))
 
     if args.distributed:
         if args.dist_url == "env://" and args.rank == -1:
@@ -154,12 +209,16 @@ def main_worker(gpu, ngpus_per_node, args):
         if args.multiprocessing_distributed:
             # For multiprocessing distributed training, rank needs to be the
             # global rank among all the processes
-            args.rank = args.rank * ngpus_per_node + gpu
+            args.rank = args.rank * ngpus_per_node + local_rank
         dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
                                 world_size=args.world_size, rank=args.rank)
+    else:
+        args.rank = 0
 
     print("=> creating model '{}'".format("TD_base"))
-    model = TD_base().cuda()
+    model = TD_base().to(args.device)
+    model.set_checkpointing(heads='heads' in args.checkpoint_activations,
+                            blocks='blocks' in args.checkpoint_activations)
     criterion = nn.L1Loss()
 
     optimizer = torch.optim.Adam(model.parameters(), args.lr,
@@ -170,7 +229,7 @@ def main_worker(gpu, ngpus_per_node, args):
     if args.resume:
         if os.path.isfile(args.resume):
             print("=> loading checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume)
+            checkpoint = torch.load(args.resume, map_location='cpu')
             if not args.reset_epoch:
                 args.start_epoch = checkpoint['epoch']
             #args.start_epoch = 10
@@ -181,31 +240,26 @@ def main_worker(gpu, ngpus_per_node, args):
         else:
             print("=> no checkpoint found at '{}'".format(args.resume))
 
+    # hooks only exist with --profile, a plain run pays nothing
+    profiler = ModuleProfiler(model).attach() if args.profile else None
+
     cudnn.benchmark = True
 
+    # only the heads and tail of the current task are used in a forward, DDP
+    # must not wait for gradients of the other tasks' parameters
     if args.distributed:
         # For multiprocessing distributed, DistributedDataParallel constructor
         # should always set the single device scope, otherwise,
         # DistributedDataParallel will use all available devices.
-        if args.gpu is not None:
-            torch.cuda.set_device(args.gpu)
-            model.cuda(args.gpu)
-            # When using a single GPU per process and per
-            # DistributedDataParallel, we need to divide the batch size
-            # ourselves based on the total number of GPUs we have
-            args.batch_size = int(args.batch_size / ngpus_per_node)
-            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
-        else:
-            model.cuda()
-            # DistributedDataParallel will divide and allocate batch_size to all
-            # available GPUs if device_ids are not set
-            model = torch.nn.parallel.DistributedDataParallel(model)
-    elif args.gpu is not None:
-        torch.cuda.set_device(args.gpu)
-        model = model.cuda(args.gpu)
-    else:
+        # With a single GPU or CPU process per rank we need to divide the
+        # batch size ourselves based on the number of processes per node
+        args.batch_size = int(args.batch_size / ngpus_per_node)
+        device_ids = [args.gpu] if args.gpu is not None else None
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids,
+                                                          find_unused_parameters=True)
+    elif args.gpu is None and args.device.type == 'cuda' and torch.cuda.device_count() > 1:
         # DataParallel will divide and allocate batch_size to all available GPUs
-        model = torch.nn.DataParallel(model).cuda()
+        model = torch.nn.DataParallel(model)
     input_size = 48
 
     # Data loading code
@@ -215,51 +269,77 @@ def main_worker(gpu, ngpus_per_node, args):
                                 ])
     if args.eval:
         val_dataset = ImageProcessDataset(args.eval_data, transform=trans)
-        val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=16)
+        val_sampler = torch.utils.data.distributed.DistributedSampler(val_dataset, shuffle=False) \
+            if args.distributed else None
+        val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers,
+                                sampler=val_sampler, pin_memory=args.non_blocking)
         #raise RuntimeError("evaluate dataloader not implemented")
         validate(val_loader, model, criterion, args)
+        if profiler is not None and args.rank == 0:
+            print(profiler.report())
         return
     
     train_dataset = ImageProcessDataset(args.data, transform=trans)
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=16)
-
-    args.epoch_size = len(train_loader)
-    print(f"Each epoch contains {args.epoch_size} iterations")
-
-    print(f"Using {args.lr_policy} learning rate")
 
     if args.distributed:
-        raise RuntimeError("distributed not implemented")
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
     else:
         train_sampler = None
 
-    scaler = amp.GradScaler() if args.fp16 else None
+    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
+                              num_workers=args.workers, sampler=train_sampler, pin_memory=args.non_blocking)
+
+    args.epoch_size = len(train_loader)
+    # per iteration lr policies advance once per optimizer step
+    args.steps_per_epoch = math.ceil(args.epoch_size / args.accumulation_steps)
+    print(f"Each epoch contains {args.epoch_size} iterations, {args.steps_per_epoch} optimizer steps")
+
+    print(f"Using {args.lr_policy} learning rate")
+
+    # bf16 has the fp32 exponent range, only fp16 needs loss scaling
+    scaler = amp.GradScaler() if args.precision == 'fp16' else None
+    trace = chrome_trace(args.profile_trace, args.profile_start, args.profile_steps) \
+        if args.profile_trace and args.rank == 0 else None
+    if trace is not None:
+        trace.start()
     print(args)
     for epoch in range(args.start_epoch, args.epochs):
         if args.distributed:
             train_sampler.set_epoch(epoch)
         # adjust_learning_rate(optimizer, epoch, args)
         # train for one epoch
-        train(train_loader, model, criterion, optimizer, epoch, args, scaler)
+        train(train_loader, model, criterion, optimizer, epoch, args, scaler, profiler, trace)
 
         # evaluate on validation set
         # validate(val_loader, model, criterion, args)
 
         
-        if not args.multiprocessing_distributed or (args.multiprocessing_distributed
-                and args.rank % ngpus_per_node == 0):
-            model_to_save = getattr(model, "module", model)
+        # all ranks hold the same weights, only the first one writes them
+        if args.rank == 0:
+            model_to_save = unwrap_model(model)
             save_checkpoint({
                 'epoch': epoch + 1,
                 'state_dict': model_to_save.state_dict(),
                 'optimizer' : optimizer.state_dict(),
             }, path=args.save_path)
-        
+
+    if trace is not None:
+        trace.stop()
 
 task_map = {"denoise30": 0, "denoise50": 1, "SRx2": 2, "SRx3": 3, "SRx4": 4, "dehaze": 5}
 
-def train(train_loader, model, criterion, optimizer, epoch, args, scaler=None):
+AUTOCAST_DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+def autocast(args):
+    """Autocast context of args.precision on args.device, disabled for fp32"""
+    return torch.autocast(args.device.type, dtype=AUTOCAST_DTYPES[args.precision],
+                          enabled=args.precision != 'fp32')
+
+def unwrap_model(model):
+    """The bare model inside a DataParallel/DistributedDataParallel wrapper, if any"""
+    return getattr(model, "module", model)
+
+def train(train_loader, model, criterion, optimizer, epoch, args, scaler=None, profiler=None, trace=None):
     # train for one epoch
     batch_time = AverageMeter()
     data_time = AverageMeter()
@@ -279,42 +359,59 @@ def train(train_loader, model, criterion, optimizer, epoch, args, scaler=None):
         local_lr = adjust_learning_rate_epoch_poly(optimizer, epoch, args)
         
     
+    accumulation = args.accumulation_steps
+    optimizer.zero_grad()
     for i, (target, input_group) in enumerate(train_loader):
+        # the last step of an epoch may get fewer micro-batches
+        micro_batches = min(accumulation, args.epoch_size - i // accumulation * accumulation)
+        last_micro_batch = (i + 1) % accumulation == 0 or i + 1 == args.epoch_size
 
         # set random task
         task_id = random.randint(0, 5) if not args.task else task_map[args.task]
         input = input_group[task_id]
-        model.module.set_task(task_id)
+        unwrap_model(model).set_task(task_id)
         #print(f"Iter {i}, task_id: {task_id}")
         #for m in model.module.modules():
            # if isinstance(m, )
             #print(m.weight.device)
-        global_iter = epoch * args.epoch_size + i
+        global_step = epoch * args.steps_per_epoch + i // accumulation
         
-        if args.lr_policy == 'iter_poly':
-            local_lr = adjust_learning_rate_poly(optimizer, global_iter, args)
-        elif args.lr_policy == 'cosine':
-            local_lr = adjust_learning_rate_cosine(optimizer, global_iter, args)
+        if i % accumulation == 0:
+            if args.lr_policy == 'iter_poly':
+                local_lr = adjust_learning_rate_poly(optimizer, global_step, args)
+            elif args.lr_policy == 'cosine':
+                local_lr = adjust_learning_rate_cosine(optimizer, global_step, args)
         
         # measure data loading time
         data_time.update(time.time() - end)
 
-        if args.gpu is not None:
-            input = input.cuda(args.gpu, non_blocking=True)
-            target = target.cuda(args.gpu, non_blocking=True)
+        input = input.to(args.device, non_blocking=args.non_blocking)
+        target = target.to(args.device, non_blocking=args.non_blocking)
 
-        target = target.cuda()
-        if scaler is None:
-            # compute output
-            output = model(input)
-            #print(output.device, target.device)
-            loss = criterion(output, target)
-        else:
-            with autocast():
+        # DDP only all-reduces gradients on the micro-batch that steps the optimizer
+        sync = nullcontext() if last_micro_batch or not isinstance(model, nn.parallel.DistributedDataParallel) \
+            else model.no_sync()
+        with sync:
+            with autocast(args):
                 # compute output
                 output = model(input)
-                #print(output.device, target.device)
-                loss = criterion(output, target)
+            #print(output.device, target.device)
+            output = output.float()
+            loss = criterion(output, target)
+            # summed over the micro-batches, the gradient is that of the mean loss
+            if scaler is None:
+                (loss / micro_batches).backward()
+            else:
+                scaler.scale(loss / micro_batches).backward()
+
+        if last_micro_batch:
+            # compute gradient and do SGD step
+            if scaler is None:
+                optimizer.step()
+            else:
+                scaler.step(optimizer)
+                scaler.update()
+            optimizer.zero_grad()
 
         # measure accuracy and record loss
         output = (output * 0.5 + 0.5) * 255.
@@ -323,23 +420,13 @@ def train(train_loader, model, criterion, optimizer, epoch, args, scaler=None):
         losses.update(loss.item(), input.size(0))
         psnr_out.update(psnr.item(), input.size(0))
 
-        # compute gradient and do SGD step
-        optimizer.zero_grad()
-
-        if scaler is None:
-            # compute gradient and do SGD step
-            loss.backward()
-            optimizer.step()
-        else:
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
-
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
+        if trace is not None:
+            trace.step()
 
-        if i % args.print_freq == 0:
+        if i % args.print_freq == 0 and args.rank == 0:
             print('Epoch: [{0}][{1}/{2}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
@@ -349,6 +436,18 @@ def train(train_loader, model, criterion, optimizer, epoch, args, scaler=None):
                    epoch, i, args.epoch_size, batch_time=batch_time,
                    data_time=data_time, loss=losses, psnr=psnr_out, lr=local_lr))
 
+    # average over every rank, not only the samples this process saw
+    losses.all_reduce()
+    psnr_out.all_reduce()
+    if args.rank == 0:
+        print(' * Epoch [{0}] Loss {loss.avg:.4f}\tPSNR {psnr.avg:.3f}'.format(epoch, loss=losses, psnr=psnr_out))
+        if profiler is not None:
+            print(' * Data {data_time.sum:.3f}s of {batch_time.sum:.3f}s'.format(
+                data_time=data_time, batch_time=batch_time))
+            print(profiler.report())
+    if profiler is not None:
+        profiler.reset()
+
 
 def validate(val_loader, model, criterion, args):
     batch_time = AverageMeter()
@@ -364,13 +463,13 @@ def validate(val_loader, model, criterion, args):
         for i, (target, input_group) in enumerate(val_loader):
             task_id = task_map[args.task]
             input = input_group[task_id]
-            model.module.set_task(task_id)
-            if args.gpu is not None:
-                input = input.cuda(args.gpu, non_blocking=True)
-                target = target.cuda(args.gpu, non_blocking=True)
-            target = target.cuda()
+            unwrap_model(model).set_task(task_id)
+            input = input.to(args.device, non_blocking=args.non_blocking)
+            target = target.to(args.device, non_blocking=args.non_blocking)
             # compute output
-            output = model(input)
+            with autocast(args):
+                output = model(input)
+            output = output.float()
             loss = criterion(output, target)
 
             # measure accuracy and record loss
@@ -386,7 +485,7 @@ def validate(val_loader, model, criterion, args):
             batch_time.update(time.time() - end)
             end = time.time()
 
-            if i % args.print_freq == 0:
+            if i % args.print_freq == 0 and args.rank == 0:
                 print('Test: [{0}/{1}]\t'
                       'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                       'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
@@ -395,8 +494,11 @@ def validate(val_loader, model, criterion, args):
                        i, len(val_loader), batch_time=batch_time, loss=losses, psnr1=psnr_out, psnr2=psnr_in
                     ))
 
-        print(' * PSNR_Out {psnr1.val:.3f} ({psnr1.avg:.3f})\t'
-                 'PSNR_In {psnr2.val:.3f} ({psnr2.avg:.3f})'.format(psnr1=psnr_out, psnr2=psnr_in))
+        losses.all_reduce()
+        psnr_out.all_reduce()
+        if args.rank == 0:
+            print(' * PSNR_Out {psnr1.val:.3f} ({psnr1.avg:.3f})\t'
+                     'PSNR_In {psnr2.val:.3f} ({psnr2.avg:.3f})'.format(psnr1=psnr_out, psnr2=psnr_in))
 
     return psnr_out.avg
 
@@ -434,6 +536,16 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+    def all_reduce(self):
+        """Sums the meter over all distributed ranks"""
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+        total = torch.tensor([self.sum, self.count], dtype=torch.float64, device=device)
+        dist.all_reduce(total, dist.ReduceOp.SUM)
+        self.sum, self.count = total.tolist()
+        self.avg = self.sum / self.count if self.count else 0
+
 def adjust_learning_rate_naive(optimizer, epoch, args):
     """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
     lr = args.lr if epoch < 200 else 2/5 * args.lr
@@ -456,16 +568,16 @@ def adjust_learning_rate_epoch_poly(optimizer, epoch, args):
     return lr
 
 def adjust_learning_rate_poly(optimizer, global_iter, args):
-    """Sets iter poly learning rate"""
-    lr = args.lr * ((1 - global_iter * 1.0 / (args.epochs * args.epoch_size)) ** args.power)
+    """Sets iter poly learning rate, global_iter counts optimizer steps"""
+    lr = args.lr * ((1 - global_iter * 1.0 / (args.epochs * args.steps_per_epoch)) ** args.power)
     for param_group in optimizer.param_groups:
         param_group['lr'] = lr
     return lr
 
 def adjust_learning_rate_cosine(optimizer, global_iter, args):
     warmup_lr = args.lr * args.warmup_lr_multiplier
-    max_iter = args.epochs * args.epoch_size
-    warmup_iter = args.warmup_epochs * args.epoch_size
+    max_iter = args.epochs * args.steps_per_epoch
+    warmup_iter = args.warmup_epochs * args.steps_per_epoch
     if global_iter < warmup_iter:
         slope = (args.lr - warmup_lr) / warmup_iter
         lr = slope * global_iter + warmup_lr
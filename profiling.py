@@ -0,0 +1,137 @@
+import collections
+import time
+
+import torch
+import torch.nn as nn
+
+from TD_multi import Attention, recomputing
+
+
+def first_tensor(value):
+    if isinstance(value, torch.Tensor):
+        return value
+    if isinstance(value, (tuple, list)):
+        for v in value:
+            if isinstance(v, torch.Tensor):
+                return v
+    return None
+
+
+def estimate_flops(module, inputs, output):
+    """ Multiply-adds * 2 done by module itself, not counting its submodules """
+    if isinstance(module, nn.Conv2d):
+        kh, kw = module.kernel_size
+        return 2 * output.numel() * module.in_channels // module.groups * kh * kw
+    if isinstance(module, nn.Linear):
+        return 2 * output.numel() * module.in_features
+    if isinstance(module, Attention):
+        q, k = inputs[0], inputs[1]
+        N, L, D = q.shape
+        S = k.shape[1]
+        grid = inputs[3] if len(inputs) > 3 else None
+        # packed qkv projections run as F.linear inside the module, then q @ k^T and attn @ v
+        flops = 2 * N * (L + 2 * S) * D * D
+        if module.window and grid is not None and max(grid) > module.window:
+            # window attention, each token only sees the tokens of its window
+            S = module.window ** 2
+        return flops + 4 * N * L * S * D
+    return 0
+
+
+class ModuleStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.forward = 0.
+        self.backward = 0.
+        self.recompute = 0.
+        self.flops = 0
+        self.activations = 0
+
+
+class ModuleProfiler(object):
+    """ Forward/backward wall time, FLOPs estimate and output activation memory of every
+    submodule of model, summed per module type. Times are inclusive of submodules.
+    Backward time runs from the gradient of a module's output to the gradient of its
+    input, so it also covers other consumers of that input. Forwards run again by
+    activation checkpointing only count as recompute time. Nothing is hooked until
+    attach() is called.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.handles = []
+        self.starts = {}
+        self.stats = collections.defaultdict(ModuleStats)
+
+    def attach(self):
+        for module in self.model.modules():
+            self.handles.append(module.register_forward_pre_hook(self.pre_forward))
+            self.handles.append(module.register_forward_hook(self.post_forward))
+        return self
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def reset(self):
+        self.stats.clear()
+
+    def pre_forward(self, module, inputs):
+        self.starts[id(module)] = time.perf_counter()
+
+    def post_forward(self, module, inputs, output):
+        stats = self.stats[type(module).__name__]
+        elapsed = time.perf_counter() - self.starts.pop(id(module))
+        if recomputing():
+            # activation checkpointing runs the forward again in backward, it is not another call
+            stats.recompute += elapsed
+            return
+        stats.calls += 1
+        stats.forward += elapsed
+        out = first_tensor(output)
+        if out is None:
+            return
+        stats.flops += estimate_flops(module, inputs, out)
+        stats.activations += out.numel() * out.element_size()
+
+        inp = next((x for x in inputs if isinstance(x, torch.Tensor) and x.requires_grad), None)
+        if out.requires_grad and inp is not None and torch.is_grad_enabled():
+            start = []
+            out.register_hook(lambda grad: start.append(time.perf_counter()))
+            inp.register_hook(lambda grad: self.add_backward(stats, start))
+
+    def add_backward(self, stats, start):
+        if start:
+            stats.backward += time.perf_counter() - start.pop()
+
+    def report(self):
+        lines = ['{:<28}\t{:>6}\t{:>10}\t{:>10}\t{:>10}\t{:>9}\t{:>9}\t{:>10}'.format(
+            'module', 'calls', 'fwd ms', 'bwd ms', 'recomp ms', 'GFLOP', 'GFLOP/s', 'act MB')]
+        for name, s in sorted(self.stats.items(), key=lambda item: -item[1].forward):
+            lines.append('{:<28}\t{:>6}\t{:>10.2f}\t{:>10.2f}\t{:>10.2f}\t{:>9.3f}\t{:>9.2f}\t{:>10.1f}'.format(
+                name, s.calls, s.forward * 1000, s.backward * 1000, s.recompute * 1000, s.flops / 1e9,
+                s.flops / 1e9 / s.forward if s.forward > 0 else 0., s.activations / 2 ** 20))
+        return '\n'.join(lines)
+
+
+def chrome_trace(path, start=5, steps=3):
+    """ torch.profiler session writing a Chrome trace of iterations [start, start + steps)
+    to path, driven by calling step() once per iteration.
+    """
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(
+        activities=activities, record_shapes=True, profile_memory=True,
+        schedule=torch.profiler.schedule(wait=max(start - 1, 0), warmup=min(start, 1), active=steps, repeat=1),
+        on_trace_ready=lambda prof: prof.export_chrome_trace(path))
+
+
+def large_allocations(fn, min_bytes=1 << 20):
+    """ (operator, bytes) of the operators that allocate at least min_bytes of CPU memory
+    themselves while fn() runs, from a torch.profiler memory trace
+    """
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return [(e.name, e.self_cpu_memory_usage) for e in prof.events() if e.self_cpu_memory_usage >= min_bytes]
@@ -0,0 +1,199 @@
+import argparse
+import copy
+import os
+import time
+import warnings
+
+import torch
+import torch.nn as nn
+import torch.ao.quantization as tq
+from PIL import Image
+import torchvision.transforms.functional as TF
+
+from TD_multi import Attention, SingleTaskTransformer
+from tiling import TiledDehazer
+
+parser = argparse.ArgumentParser(description='INT8 quantization of TransDehaze for CPU inference')
+parser.add_argument('inputs', nargs='+', metavar='PATH',
+                    help='hazy images, glob patterns or directories used for calibration and evaluation')
+parser.add_argument('--resume', default='', type=str, metavar='PATH',
+                    help='fp32 checkpoint saved by save_checkpoint')
+parser.add_argument('-o', '--output', default='checkpoint_int8.pth.tar', type=str, metavar='PATH',
+                    help='where to save the quantized checkpoint')
+parser.add_argument('--heads', action='store_true',
+                    help='also statically quantize the dehaze Head convolutions, calibrated on the inputs')
+parser.add_argument('--calibration-crops', default=64, type=int, metavar='N',
+                    help='random 48x48 crops per image for calibration (default: 64)')
+parser.add_argument('--ref', default='', type=str, metavar='DIR',
+                    help='clear references, matched by file name, to report PSNR against ground truth')
+parser.add_argument('-b', '--batch-size', default=64, type=int, metavar='N',
+                    help='48x48 tiles per forward (default: 64)')
+
+
+def slice_linear(linear, start, end):
+    out = nn.Linear(linear.in_features, end - start, bias=linear.bias is not None)
+    with torch.no_grad():
+        out.weight.copy_(linear.weight[start:end])
+        if linear.bias is not None:
+            out.bias.copy_(linear.bias[start:end])
+    return out
+
+
+class SplitQKV(nn.Module):
+    """ Packed qkv projection of an Attention as separate query, key and value linears,
+    so each one can be quantized on its own. Inputs shared by query and key go through
+    q and k, the same work as the packed matmul without a second copy of the weights.
+    """
+
+    def __init__(self, qkv):
+        super(SplitQKV, self).__init__()
+        D = qkv.out_features // 3
+        self.q = slice_linear(qkv, 0, D)
+        self.k = slice_linear(qkv, D, 2 * D)
+        self.v = slice_linear(qkv, 2 * D, 3 * D)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # int8 checkpoints of earlier versions also hold a packed query/key copy
+        for key in [key for key in state_dict if key.startswith(prefix + 'qk.')]:
+            del state_dict[key]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, q, k, v):
+        return self.q(q), self.k(k), self.v(v)
+
+
+class QuantizedHead(nn.Module):
+    """ Head running on quantized activations, float tensors in and out """
+
+    def __init__(self, head):
+        super(QuantizedHead, self).__init__()
+        self.quant = tq.QuantStub()
+        self.head = head
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.head(self.quant(x)))
+
+
+def head_slots(model, task_id=5):
+    """ (parent, name) of the three Heads of task_id: in the head sets of a TD_base,
+    or the heads of a SingleTaskTransformer
+    """
+    if isinstance(model, SingleTaskTransformer):
+        return [(model, name) for name in ('head', 'head2', 'head3')]
+    return [(heads, str(task_id)) for heads in (model.headsets, model.headsets2, model.headsets3)]
+
+
+def quantize_heads(model, calibration=(), task_id=5):
+    """ Static int8 quantization of the three Heads of task_id.
+    calibration yields input batches, run through the whole model to observe
+    the activation ranges of the heads.
+    """
+    qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+    slots = head_slots(model, task_id)
+    for parent, name in slots:
+        head = getattr(parent, name)
+        for block in (head.resblock1, head.resblock2):
+            tq.fuse_modules(block, [['conv1', 'relu']], inplace=True)
+        head = QuantizedHead(head)
+        head.qconfig = qconfig
+        setattr(parent, name, tq.prepare(head))
+    with torch.no_grad():
+        for x in calibration:
+            model(x)
+    for parent, name in slots:
+        tq.convert(getattr(parent, name), inplace=True)
+    return model
+
+
+def quantize_model(model, heads=False, calibration=()):
+    """ Dynamic int8 quantization of the attention and ffn linears of an eval model,
+    in place. With heads=True the dehaze Heads are statically quantized as well.
+    """
+    model.eval()
+    for m in model.modules():
+        if isinstance(m, Attention) and isinstance(m.qkv, nn.Linear):
+            m.qkv = SplitQKV(m.qkv)
+    if heads:
+        quantize_heads(model, calibration)
+    return tq.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def save_quantized(model, path, heads=False):
+    state = {
+        'quantization': {'dynamic': True, 'heads': heads, 'engine': torch.backends.quantized.engine},
+        'state_dict': model.state_dict(),
+    }
+    if isinstance(model, SingleTaskTransformer):
+        # load_model rebuilds TD_single for it, like for a slim checkpoint
+        state['single_task'] = model.task_id
+    torch.save(state, path)
+
+
+def load_quantized(model, state):
+    """ Rebuild the quantized structure of a fp32 model and load a save_quantized() state """
+    config = state['quantization']
+    torch.backends.quantized.engine = config['engine']
+    with warnings.catch_warnings():
+        # observers without calibration data warn, their qparams come from the checkpoint
+        warnings.simplefilter('ignore')
+        quantize_model(model, heads=config['heads'])
+    model.load_state_dict(state['state_dict'])
+    return model
+
+
+def calibration_batches(images, crops, size=48, batch_size=16):
+    crop_list = []
+    for x in images:
+        H, W = x.shape[-2:]
+        for _ in range(crops):
+            top = torch.randint(0, max(H - size, 0) + 1, ()).item()
+            left = torch.randint(0, max(W - size, 0) + 1, ()).item()
+            crop = x[:, top:top + size, left:left + size]
+            if crop.shape[-2:] == (size, size):
+                crop_list.append(crop)
+    for i in range(0, len(crop_list), batch_size):
+        yield torch.stack(crop_list[i:i + batch_size])
+
+
+def psnr(img1, img2):
+    """ img1 and img2 in [-1, 1], PSNR computed on the [0, 255] range """
+    mse = torch.mean(((img1 - img2) * 127.5) ** 2)
+    return (20 * torch.log10(255.0 / torch.sqrt(mse))).item()
+
+
+def main():
+    # dehaze.py loads quantized checkpoints through this module
+    from dehaze import collect_images, load_model
+
+    args = parser.parse_args()
+    paths = collect_images(args.inputs)
+    images = [TF.to_tensor(Image.open(p).convert('RGB')) * 2 - 1 for p in paths]
+
+    model = load_model(args.resume)
+    qmodel = quantize_model(copy.deepcopy(model), heads=args.heads,
+                            calibration=calibration_batches(images, args.calibration_crops))
+    save_quantized(qmodel, args.output, heads=args.heads)
+    print("=> saved quantized checkpoint '{}' ({:.1f} MB)".format(args.output, os.path.getsize(args.output) / 2 ** 20))
+
+    fp32 = TiledDehazer(model, batch_size=args.batch_size)
+    int8 = TiledDehazer(qmodel, batch_size=args.batch_size)
+    times = {'fp32': 0., 'int8': 0.}
+    for path, x in zip(paths, images):
+        out = {}
+        for name, tiler in (('fp32', fp32), ('int8', int8)):
+            start = time.time()
+            out[name] = tiler(x)
+            times[name] += time.time() - start
+        line = '{}\tPSNR int8 vs fp32 {:.2f}'.format(path, psnr(out['int8'], out['fp32']))
+        if args.ref:
+            ref = TF.to_tensor(Image.open(os.path.join(args.ref, os.path.basename(path))).convert('RGB')) * 2 - 1
+            p32, p8 = psnr(out['fp32'], ref), psnr(out['int8'], ref)
+            line += '\tPSNR fp32 {:.2f} int8 {:.2f} (drop {:.2f})'.format(p32, p8, p32 - p8)
+        print(line)
+    print(' * fp32 {:.2f}s\tint8 {:.2f}s\tspeedup {:.2f}x'.format(
+        times['fp32'], times['int8'], times['fp32'] / times['int8']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+import argparse
+import asyncio
+import collections
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from PIL import Image
+import torchvision.transforms.functional as TF
+
+from tiling import blend_window, tile_starts
+
+parser = argparse.ArgumentParser(description='Micro-batching TransDehaze inference server')
+parser.add_argument('--resume', default='', type=str, metavar='PATH',
+                    help='checkpoint saved by save_checkpoint, slim.py or quantize.py, '
+                         'or a .onnx file with --backend onnx')
+parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'],
+                    help='run the model with PyTorch or with ONNX Runtime (default: torch)')
+parser.add_argument('--host', default='127.0.0.1', type=str)
+parser.add_argument('--port', default=8080, type=int)
+parser.add_argument('-b', '--max-batch', default=64, type=int, metavar='N',
+                    help='most 48x48 tiles per forward (default: 64)')
+parser.add_argument('--max-wait-ms', default=5., type=float, metavar='MS',
+                    help='longest a tile waits for its batch to fill (default: 5)')
+parser.add_argument('--workers', default=1, type=int, metavar='N',
+                    help='batches run concurrently on this many threads (default: 1)')
+parser.add_argument('--overlap', default=16, type=int, help='tile overlap in pixels')
+parser.add_argument('--workspace', action='store_true',
+                    help='reuse the intermediate tensors of the torch model across batches')
+parser.add_argument('--count-allocations', action='store_true',
+                    help='with --workspace and one worker, profile every forward and report its allocations '
+                         'of 1 MB or more, inside the workspace or not, in /metrics; slows batches down')
+parser.add_argument('--window', default='hann', choices=['hann', 'linear', 'none'],
+                    help='blend window for overlapping tiles')
+parser.add_argument('--no-normalize', dest='normalize', action='store_false',
+                    help='feed [0, 1] images (transdehaze.py training) instead of [-1, 1] (main.py)')
+
+
+def percentile(values, q):
+    """ Nearest rank q-th percentile of values """
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(int(round(q / 100. * (len(values) - 1))), len(values) - 1)]
+
+
+class Metrics(object):
+    """ Latency and throughput over the last window requests """
+
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.requests = 0
+        self.tiles = 0
+        self.workspace_allocations = 0
+        self.workspace_bytes = 0
+        self.profiled_batches = 0
+        self.large_allocations = 0
+        self.large_allocated_bytes = 0
+        self.start = time.time()
+
+    def record_request(self, latency, tiles):
+        self.latencies.append(latency)
+        self.requests += 1
+        self.tiles += tiles
+
+    def record_batch(self, size):
+        self.batch_sizes.append(size)
+
+    def record_workspace(self, counts):
+        self.workspace_allocations += counts['allocations']
+        self.workspace_bytes += counts['allocated_bytes']
+        if 'large_allocations' in counts:
+            self.profiled_batches += 1
+            self.large_allocations += counts['large_allocations']
+            self.large_allocated_bytes += counts['large_allocated_bytes']
+
+    def summary(self):
+        seconds = time.time() - self.start
+        latencies = list(self.latencies)
+        return {
+            'requests': self.requests,
+            'tiles': self.tiles,
+            'seconds': seconds,
+            'requests_per_sec': self.requests / seconds,
+            'tiles_per_sec': self.tiles / seconds,
+            'latency_p50': percentile(latencies, 50),
+            'latency_p95': percentile(latencies, 95),
+            'latency_p99': percentile(latencies, 99),
+            'batch_mean': sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else 0.,
+            # stops growing once every batch size has its buffers
+            'workspace_allocations': self.workspace_allocations,
+            'workspace_mb': self.workspace_bytes / 2 ** 20,
+            # every allocation of the profiled forwards, see --count-allocations
+            'large_allocations_per_batch': self.large_allocations / max(self.profiled_batches, 1),
+            'large_allocated_mb_per_batch': self.large_allocated_bytes / max(self.profiled_batches, 1) / 2 ** 20,
+        }
+
+
+class MicroBatcher(object):
+    """ Coalesces tiles of concurrent requests into dynamic batches.
+    A batch is closed once it holds max_batch tiles or its first tile has waited
+    max_wait seconds, then run on one of workers threads; torch releases the GIL
+    in its kernels, so the event loop keeps accepting requests meanwhile.
+    """
+
+    def __init__(self, model, max_batch=64, max_wait=0.005, workers=1, metrics=None, count_allocations=False):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.workers = workers
+        self.metrics = metrics or Metrics()
+        self.count_allocations = count_allocations
+        self.pool = ThreadPoolExecutor(workers)
+        self.queue = None
+        self.tasks = []
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.ensure_future(self.run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.pool.shutdown()
+
+    def submit(self, tile):
+        """ Future of the model output for one C H W tile """
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((tile, future))
+        return future
+
+    def forward(self, batch):
+        workspace = getattr(self.model, 'workspace', None)
+        # grad mode is per thread
+        with torch.no_grad():
+            if workspace is not None and self.count_allocations:
+                out = workspace.profile(lambda: self.model(batch)).float().cpu()
+            else:
+                out = self.model(batch).float().cpu()
+        if workspace is not None:
+            # counts are per thread, read them in the worker that ran the forward
+            self.metrics.record_workspace(workspace.counts)
+        return out
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        items = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(items) < self.max_batch:
+            if not self.queue.empty():
+                items.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = await self.next_batch()
+            batch = torch.stack([tile for tile, _ in items])
+            try:
+                out = await loop.run_in_executor(self.pool, self.forward, batch)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.metrics.record_batch(len(items))
+            for (_, future), o in zip(items, out):
+                if not future.done():
+                    future.set_result(o)
+
+
+class DehazeServer(object):
+    """ Tiles each request image, sends the tiles through a MicroBatcher and blends
+    them back, served over a minimal HTTP/1.1:
+    POST /dehaze with an encoded image as body answers the dehazed PNG,
+    GET /metrics answers the Metrics summary as json.
+    """
+
+    def __init__(self, model, max_batch=64, max_wait=0.005, workers=1, tile_size=48, overlap=16,
+                 window='hann', normalize=True, count_allocations=False):
+        if not 0 <= overlap < tile_size:
+            raise ValueError("overlap must be in [0, tile_size)")
+        self.metrics = Metrics()
+        self.batcher = MicroBatcher(model, max_batch, max_wait, workers, self.metrics, count_allocations)
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.weight = blend_window(tile_size, overlap, window)
+        self.normalize = normalize
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=8080):
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def dehaze(self, image):
+        """ C H W tensor in, dehazed C H W tensor out """
+        start = time.time()
+        C, H, W = image.shape
+        t = self.tile_size
+        pad_h, pad_w = max(t - H, 0), max(t - W, 0)
+        if pad_h or pad_w:
+            image = torch.nn.functional.pad(image[None], (0, pad_w, 0, pad_h), mode='replicate')[0]
+        Hp, Wp = image.shape[-2:]
+        stride = t - self.overlap
+        coords = [(top, left) for top in tile_starts(Hp, t, stride) for left in tile_starts(Wp, t, stride)]
+        outs = await asyncio.gather(*[self.batcher.submit(image[:, top:top + t, left:left + t])
+                                      for top, left in coords])
+
+        out = torch.zeros((outs[0].shape[0], Hp, Wp))
+        norm = torch.zeros((1, Hp, Wp))
+        for (top, left), o in zip(coords, outs):
+            out[:, top:top + t, left:left + t] += o * self.weight
+            norm[:, top:top + t, left:left + t] += self.weight
+        self.metrics.record_request(time.time() - start, len(coords))
+        return (out / norm)[:, :H, :W]
+
+    async def dehaze_bytes(self, data):
+        loop = asyncio.get_running_loop()
+        image = await loop.run_in_executor(None, self.decode, data)
+        return await loop.run_in_executor(None, self.encode, await self.dehaze(image))
+
+    def decode(self, data):
+        x = TF.to_tensor(Image.open(io.BytesIO(data)).convert('RGB'))
+        return x * 2 - 1 if self.normalize else x
+
+    def encode(self, out):
+        if self.normalize:
+            out = out * 0.5 + 0.5
+        buf = io.BytesIO()
+        TF.to_pil_image(out.clamp(0, 1)).save(buf, format='PNG')
+        return buf.getvalue()
+
+    async def route(self, method, path, body):
+        if method == 'POST' and path == '/dehaze':
+            try:
+                return 200, 'image/png', await self.dehaze_bytes(body)
+            except (OSError, ValueError) as e:
+                return 400, 'text/plain', str(e).encode()
+            except Exception as e:
+                # e.g. a RuntimeError of the model, the client still gets an answer
+                return 500, 'text/plain', '{}: {}'.format(type(e).__name__, e).encode()
+        if method == 'GET' and path == '/metrics':
+            return 200, 'application/json', json.dumps(self.metrics.summary()).encode()
+        return 404, 'text/plain', b'not found'
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, _ = line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    key, value = header.decode('latin-1').split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, content_type, payload = await self.route(method, path, body)
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                    status, {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                             500: 'Internal Server Error'}[status], content_type,
+                    len(payload)).encode('latin-1') + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def build_server(args):
+    from dehaze import load_backend
+
+    model = load_backend(args.resume, args.backend)
+    if args.workspace:
+        if not hasattr(model, 'set_workspace'):
+            raise ValueError("--workspace needs the torch backend")
+        model.set_workspace(True)
+    if args.count_allocations and not (args.workspace and args.workers == 1):
+        # the profiler is process wide, concurrent forwards would mix their allocations
+        raise ValueError("--count-allocations needs --workspace and one worker")
+    return DehazeServer(model, max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000., workers=args.workers,
+                        overlap=args.overlap, window=args.window, normalize=args.normalize,
+                        count_allocations=args.count_allocations)
+
+
+async def serve(args):
+    server = build_server(args)
+    host, port = await server.start(args.host, args.port)
+    print("=> serving on http://{}:{}".format(host, port))
+    try:
+        await server.server.serve_forever()
+    finally:
+        await server.stop()
+
+
+def main():
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import os
+import time
+
+import torch
+
+from TD_multi import SingleTaskTransformer, TD_base, TD_single, single_task_state_dict
+
+parser = argparse.ArgumentParser(description='Slim a full TransDehaze checkpoint down to one task')
+parser.add_argument('checkpoint', metavar='PATH', help='full checkpoint saved by save_checkpoint')
+parser.add_argument('-o', '--output', default='checkpoint_dehaze.pth.tar', type=str, metavar='PATH',
+                    help='where to save the single task checkpoint')
+parser.add_argument('--task', default=5, type=int, help='task to keep (default: 5, dehaze)')
+
+
+def param_stats(model):
+    """ (parameter count, bytes held by parameters and buffers) """
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(p.numel() for p in model.parameters()), sum(t.numel() * t.element_size() for t in tensors)
+
+
+def slim_checkpoint(state, task_id=5):
+    """ Single task checkpoint out of a save_checkpoint() state, without the optimizer """
+    return {
+        'epoch': state.get('epoch'),
+        'single_task': task_id,
+        'state_dict': single_task_state_dict(state.get('state_dict', state), task_id),
+    }
+
+
+def timed_load(build, state_dict):
+    start = time.time()
+    model = build()
+    model.load_state_dict(state_dict)
+    return model.eval(), time.time() - start
+
+
+def main():
+    args = parser.parse_args()
+
+    state = torch.load(args.checkpoint, map_location='cpu', weights_only=False)
+    slim = slim_checkpoint(state, args.task)
+    torch.save(slim, args.output)
+
+    full_state_dict = {k[len('module.'):] if k.startswith('module.') else k: v
+                       for k, v in state.get('state_dict', state).items()}
+    full, full_seconds = timed_load(TD_base, full_state_dict)
+    single, single_seconds = timed_load(lambda: TD_single(args.task), slim['state_dict'])
+    # the full model's forward always runs task 5, its task path is taken out as the slim one is
+    reference = SingleTaskTransformer(full, args.task).eval()
+    x = torch.randn(2, 3, 48, 48)
+    with torch.no_grad():
+        diff = (reference(x) - single(x)).abs().max().item()
+
+    (full_params, full_bytes), (single_params, single_bytes) = param_stats(full), param_stats(single)
+    full_size, single_size = os.path.getsize(args.checkpoint), os.path.getsize(args.output)
+    print("=> saved task {} checkpoint '{}', max diff against the full model {:.2e}".format(
+        args.task, args.output, diff))
+    print('\tfull\tsingle\tsaved')
+    print('params\t{:.2f}M\t{:.2f}M\t{:.1f}%'.format(
+        full_params / 1e6, single_params / 1e6, 100 * (1 - single_params / full_params)))
+    print('memory\t{:.1f}MB\t{:.1f}MB\t{:.1f}%'.format(
+        full_bytes / 2 ** 20, single_bytes / 2 ** 20, 100 * (1 - single_bytes / full_bytes)))
+    print('file\t{:.1f}MB\t{:.1f}MB\t{:.1f}%'.format(
+        full_size / 2 ** 20, single_size / 2 ** 20, 100 * (1 - single_size / full_size)))
+    print('load\t{:.2f}s\t{:.2f}s\t{:.1f}%'.format(
+        full_seconds, single_seconds, 100 * (1 - single_seconds / full_seconds)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+import TD_multi
+from TD_multi import Attention, TD_base
+
+
+def separate_qkv(state_dict):
+    # the checkpoint layout before the packed projection: query, key and value linears
+    state = {}
+    for key, value in state_dict.items():
+        if '.qkv.' in key or key.startswith('qkv.'):
+            prefix, name = key.rsplit('qkv.', 1)
+            for m, t in zip(('query', 'key', 'value'), value.chunk(3)):
+                state[prefix + m + '.' + name] = t.clone()
+        else:
+            state[key] = value
+    return state
+
+
+def reference_attention(state, q, k, v, num_heads, mask=None, scale=None):
+    # the original attention, separate projections and a materialized attention matrix
+    q = F.linear(q, state['query.weight'], state['query.bias'])
+    k = F.linear(k, state['key.weight'], state['key.bias'])
+    v = F.linear(v, state['value.weight'], state['value.bias'])
+    N, L, D = q.shape
+
+    def heads(t):
+        return t.reshape(N, -1, num_heads, D // num_heads).transpose(1, 2)
+
+    attn = heads(q) @ heads(k).transpose(-2, -1) * (scale or (D // num_heads) ** -0.5)
+    if mask is not None:
+        attn = attn.masked_fill(~mask, float('-inf'))
+    attn = attn.softmax(dim=-1)
+    x = (attn @ heads(v)).transpose(1, 2).reshape(N, L, D)
+    return F.linear(x, state['proj.weight'], state['proj.bias'])
+
+
+def test_separate_qkv_state_dict_loads_packed():
+    torch.manual_seed(0)
+    state = separate_qkv(Attention(64, num_heads=4, qkv_bias=True).state_dict())
+    attn = Attention(64, num_heads=4, qkv_bias=True).eval()
+    attn.load_state_dict(dict(state))
+    assert torch.equal(attn.qkv.weight, torch.cat([state[m + '.weight'] for m in ('query', 'key', 'value')]))
+    assert torch.equal(attn.qkv.bias, torch.cat([state[m + '.bias'] for m in ('query', 'key', 'value')]))
+
+    x, memory, pos = torch.randn(2, 36, 64), torch.randn(2, 36, 64), torch.randn(1, 36, 64)
+    with torch.no_grad():
+        # self attention (one packed matmul), cross attention and embedded queries/keys
+        assert torch.allclose(attn(x, x, x), reference_attention(state, x, x, x, 4), atol=1e-5)
+        assert torch.allclose(attn(x, memory, memory), reference_attention(state, x, memory, memory, 4), atol=1e-5)
+        assert torch.allclose(attn(x, memory, memory, q_embed=pos, k_embed=pos),
+                              reference_attention(state, x + pos, memory + pos, memory, 4), atol=1e-5)
+
+
+@pytest.mark.parametrize('sdpa_scale', [True, False])
+def test_attention_qk_scale(monkeypatch, sdpa_scale):
+    # torch 2.0 has no scale argument, q is rescaled instead
+    monkeypatch.setattr(TD_multi, '_SDPA_SCALE', sdpa_scale and TD_multi._SDPA_SCALE)
+    torch.manual_seed(0)
+    attn = Attention(64, num_heads=4, qkv_bias=True, qk_scale=0.3).eval()
+    state = separate_qkv(attn.state_dict())
+    x = torch.randn(2, 36, 64)
+    with torch.no_grad():
+        assert torch.allclose(attn(x, x, x), reference_attention(state, x, x, x, 4, scale=0.3), atol=1e-5)
+
+
+def test_separate_qkv_checkpoint_loads_into_model():
+    torch.manual_seed(0)
+    source = TD_base().eval()
+    model = TD_base().eval()
+    model.load_state_dict(separate_qkv(source.state_dict()))
+    x = torch.randn(1, 3, 48, 48)
+    with torch.no_grad():
+        assert torch.equal(model(x), source(x))
+
+
+def reference_window_mask(grid, window, shift):
+    # token pairs of the same window of the grid cyclically shifted towards the top left,
+    # and on the same side of the wrap around; tokens are enumerated column by column
+    nh, nw = grid
+    ph, pw = -nh % window, -nw % window
+    col, row = torch.arange(nw).repeat_interleave(nh), torch.arange(nh).repeat(nw)
+    keys = torch.stack([(col - shift) % (nw + pw) // window, (row - shift) % (nh + ph) // window,
+                        col < shift, row < shift])
+    return (keys[:, :, None] == keys[:, None, :]).all(0)
+
+
+def test_window_attention_matches_masked_reference():
+    torch.manual_seed(0)
+    attn = Attention(32, num_heads=2, qkv_bias=True).eval()
+    state = separate_qkv(attn.state_dict())
+    # a grid of whole windows and a padded one, without and with the shift
+    for grid, shift in (((24, 24), 0), ((24, 24), 6), ((15, 20), 0), ((15, 20), 6)):
+        attn.window, attn.shift = 12, shift
+        x, pos = torch.randn(2, grid[0] * grid[1], 32), torch.randn(1, grid[0] * grid[1], 32)
+        ref = reference_attention(state, x + pos, x + pos, x, 2, reference_window_mask(grid, 12, shift))
+        with torch.no_grad():
+            assert torch.allclose(attn(x, x, x, grid, pos, pos), ref, atol=1e-5), (grid, shift)
+
+
+def test_window_attention_at_48_matches_global():
+    torch.manual_seed(0)
+    model = TD_base().eval()
+    with torch.no_grad():
+        model.task_embed.normal_(std=.02)
+    x = torch.randn(2, 3, 48, 48)
+    with torch.no_grad():
+        ref = model(x)
+        model.set_window_attention(True)
+        assert torch.equal(model(x), ref)
+        model.set_fold_embeddings(True)
+        assert torch.allclose(model(x), ref, atol=1e-5)
@@ -0,0 +1,32 @@
+import torch
+
+from TD_multi import TD_base
+
+
+def test_batched_branches_match_three_calls():
+    torch.manual_seed(0)
+    model = TD_base().eval()
+    with torch.no_grad():
+        model.task_embed.normal_(std=.02)
+    x = torch.randn(2, 3, 48, 48)
+    with torch.no_grad():
+        model.set_batch_branches(False)
+        ref = model(x)
+        model.set_batch_branches(True)
+        out = model(x)
+    assert torch.allclose(out, ref, atol=1e-5)
+
+
+def test_batched_branches_gradients_match_three_calls():
+    torch.manual_seed(0)
+    model = TD_base()
+    x = torch.randn(1, 3, 48, 48)
+    grads = []
+    for batch_branches in (False, True):
+        model.zero_grad()
+        model.set_batch_branches(batch_branches)
+        model(x).square().mean().backward()
+        grads.append([p.grad.clone() for p in model.parameters() if p.grad is not None])
+    assert len(grads[0]) == len(grads[1])
+    for ref, g in zip(*grads):
+        assert torch.allclose(g, ref, rtol=1e-4, atol=1e-6)
@@ -0,0 +1,33 @@
+import pytest
+import torch
+
+from TD_multi import TD_base
+
+
+def enlarge(model, window):
+    # resets the embedding cache, the next forward builds it again
+    if window:
+        model.set_window_attention(True)
+    else:
+        model.set_interpolate_embeddings(True)
+
+
+@pytest.mark.parametrize('window', [False, True])
+def test_fold_resized_embeddings_inference_mode(window):
+    torch.manual_seed(0)
+    model = TD_base().eval()
+    with torch.no_grad():
+        model.task_embed.normal_(std=.02)
+    x = torch.randn(1, 3, 96, 96)
+    enlarge(model, window)
+    with torch.no_grad():
+        ref = model(x)
+    enlarge(model, window)
+    model.set_fold_embeddings(True)
+    # embeddings resized and folded under inference mode first, then reused outside it
+    with torch.inference_mode():
+        folded = model(x)
+    with torch.no_grad():
+        again = model(x)
+    assert torch.allclose(folded, ref, atol=1e-5)
+    assert torch.allclose(again, ref, atol=1e-5)
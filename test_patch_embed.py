@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+from TD_multi import DePatchEmbed, PatchEmbed
+
+
+def patch_embed_reference(x, p):
+    # the original per-patch loop, kept to check the vectorized layout against
+    N, C, H, W = x.shape
+    num_patches = (H // p) * (W // p)
+    out = torch.zeros((N, num_patches, C * p * p))
+    i, j = 0, 0
+    for k in range(num_patches):
+        if i + p > W:
+            i = 0
+            j += p
+        out[:, k, :] = x[:, :, i:i + p, j:j + p].flatten(1)
+        i += p
+    return out
+
+
+def de_patch_embed_reference(x, ori_shape, p):
+    N, num_patches, dim = x.shape
+    _, C, H, W = ori_shape
+    out = torch.zeros(ori_shape)
+    i, j = 0, 0
+    for k in range(num_patches):
+        if i + p > W:
+            i = 0
+            j += p
+        out[:, :, i:i + p, j:j + p] = x[:, k, :].reshape(N, C, p, p)
+        i += p
+    return out
+
+
+@pytest.mark.parametrize('p, size', [(1, 8), (2, 12), (4, 48)])
+def test_patch_embed_matches_reference(p, size):
+    feat = torch.randn(2, 64, size, size)
+    tokens, shape = PatchEmbed(patch_size=p, in_channels=64)(feat)
+    assert torch.equal(tokens, patch_embed_reference(feat, p))
+    restored = DePatchEmbed(patch_size=p, in_channels=64)(tokens, shape)
+    assert torch.equal(restored, de_patch_embed_reference(tokens, shape, p))
+    assert torch.equal(restored, feat)
+
+
+@pytest.mark.parametrize('p, size', [(1, 8), (2, 12), (4, 48)])
+def test_patch_embed_out(p, size):
+    feat = torch.randn(2, 64, size, size)
+    tokens, _ = PatchEmbed(patch_size=p, in_channels=64)(feat)
+    assert torch.equal(PatchEmbed(patch_size=p, in_channels=64)(feat, out=torch.empty_like(tokens))[0], tokens)
+    # borders not covered by a whole patch
+    odd = torch.randn(2, 64, size + p - 1, size + p - 1)
+    assert torch.equal(DePatchEmbed(patch_size=p, in_channels=64)(tokens, odd.shape, out=torch.randn_like(odd)),
+                       DePatchEmbed(patch_size=p, in_channels=64)(tokens, odd.shape))
@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from TD_multi import SingleTaskTransformer, TD_base
+
+
+def test_workspace_inference_mode_and_no_grad():
+    torch.manual_seed(0)
+    model = TD_base().eval()
+    model.set_fold_embeddings(True)
+    model.set_workspace(True)
+    x = torch.randn(2, 3, 48, 48)
+    # buffers allocated under inference mode are written in place by a no_grad forward, and back
+    with torch.inference_mode():
+        first = model(x)
+    with torch.no_grad():
+        second = model(x)
+    with torch.inference_mode():
+        third = model(x)
+    assert model.workspace.counts['allocations'] == 0
+    assert torch.equal(first, second)
+    assert torch.equal(second, third)
+
+
+@pytest.mark.parametrize('mode', ['global', 'interpolate', 'window', 'single'])
+def test_workspace_matches_plain_forward(mode):
+    torch.manual_seed(0)
+    model = TD_base().eval()
+    with torch.no_grad():
+        model.task_embed.normal_(std=.02)
+    size = 48
+    if mode == 'interpolate':
+        model.set_interpolate_embeddings(True)
+        size = 52
+    elif mode == 'window':
+        model.set_window_attention(True)
+        size = 52
+    if mode == 'single':
+        model = SingleTaskTransformer(model).eval()
+    # the batch grows the buffers, then shrinks into views of them
+    inputs = [torch.randn(n, 3, size, size) for n in (1, 2, 1)]
+    with torch.no_grad():
+        refs = [model(x) for x in inputs]
+        for fold in (False, True):
+            model.set_fold_embeddings(fold)
+            model.set_workspace(True)
+            for x, ref in zip(inputs, refs):
+                assert torch.allclose(model(x), ref, atol=1e-5), fold
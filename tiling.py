@@ -0,0 +1,148 @@
+import argparse
+import time
+
+import torch
+
+
+def tile_starts(length, tile_size, stride):
+    """ Start offsets of tiles covering [0, length), the last one flush with the end. """
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, stride))
+    starts.append(length - tile_size)
+    return starts
+
+
+def blend_window(tile_size, overlap, window='hann'):
+    """ 2D weight map used to blend overlapping tiles.
+    Weights are strictly positive so pixels on the image border, covered by a
+    single tile, are never divided by zero.
+    """
+    if window == 'hann':
+        # drop the two zero end points of the hann window
+        w = torch.hann_window(tile_size + 2, periodic=False)[1:-1]
+    elif window == 'linear':
+        w = torch.ones(tile_size)
+        if overlap > 0:
+            ramp = torch.arange(1, overlap + 1, dtype=torch.float32) / (overlap + 1)
+            w[:overlap] = ramp
+            w[-overlap:] = ramp.flip(0)
+    elif window == 'none':
+        w = torch.ones(tile_size)
+    else:
+        raise ValueError("Unknown blend window '{}'".format(window))
+    return w[:, None] * w[None, :]
+
+
+class TileStats(object):
+    """Tiles processed and time spent by the last tiled run"""
+    def __init__(self, tiles=0, seconds=0.):
+        self.tiles = tiles
+        self.seconds = seconds
+
+    @property
+    def tiles_per_sec(self):
+        return self.tiles / self.seconds if self.seconds > 0 else 0.
+
+    def __repr__(self):
+        return "TileStats(tiles={}, seconds={:.3f}, tiles/sec={:.1f})".format(
+            self.tiles, self.seconds, self.tiles_per_sec)
+
+
+class TiledDehazer(object):
+    """ Arbitrary resolution inference with a model trained on fixed size crops.
+    The image is split into overlapping tile_size x tile_size tiles which are run
+    through the model batch_size at a time and blended back with a window, so
+    only one chunk of tiles is alive at any time besides the output image.
+    dtype, e.g. torch.bfloat16, runs the model under autocast; blending stays in float32.
+    """
+
+    def __init__(self, model, tile_size=48, overlap=16, batch_size=64, window='hann', device=None, dtype=None):
+        if not 0 <= overlap < tile_size:
+            raise ValueError("overlap must be in [0, tile_size)")
+        self.model = model
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        if device is None:
+            # backends.OnnxBackend has no parameters, it tells its device instead
+            device = model.device if hasattr(model, 'device') else next(model.parameters()).device
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.weight = blend_window(tile_size, overlap, window).to(self.device)
+        self.stats = TileStats()
+
+    def tiles(self, H, W):
+        stride = self.tile_size - self.overlap
+        for top in tile_starts(H, self.tile_size, stride):
+            for left in tile_starts(W, self.tile_size, stride):
+                yield top, left
+
+    @torch.no_grad()
+    def __call__(self, image):
+        """ image: C H W or N C H W tensor, normalized the way the model was trained """
+        squeeze = image.dim() == 3
+        if squeeze:
+            image = image[None]
+        N, C, H, W = image.shape
+        t = self.tile_size
+        # images smaller than a tile are edge padded up to one tile
+        pad_h, pad_w = max(t - H, 0), max(t - W, 0)
+        if pad_h or pad_w:
+            image = torch.nn.functional.pad(image, (0, pad_w, 0, pad_h), mode='replicate')
+        Hp, Wp = image.shape[-2:]
+
+        self.model.eval()
+        out = None
+        norm = torch.zeros((1, 1, Hp, Wp), device=self.device)
+        coords = list(self.tiles(Hp, Wp))
+        # keep batch_size tiles per forward regardless of how many images come in
+        per_chunk = max(self.batch_size // N, 1)
+        start = time.time()
+        for c in range(0, len(coords), per_chunk):
+            chunk = coords[c:c + per_chunk]
+            batch = torch.cat([image[:, :, top:top + t, left:left + t] for top, left in chunk])
+            with torch.autocast(self.device.type, dtype=self.dtype, enabled=self.dtype is not None):
+                pred = self.model(batch.to(self.device))
+            pred = pred.float()
+            if out is None:
+                out = torch.zeros((N, pred.shape[1], Hp, Wp), device=self.device)
+            pred = pred.view(len(chunk), N, *pred.shape[1:]) * self.weight
+            for k, (top, left) in enumerate(chunk):
+                out[:, :, top:top + t, left:left + t] += pred[k]
+                norm[:, :, top:top + t, left:left + t] += self.weight
+        self.stats = TileStats(len(coords) * N, time.time() - start)
+
+        out = (out / norm)[:, :, :H, :W]
+        return out[0] if squeeze else out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tiled TransDehaze inference')
+    parser.add_argument('image', help='hazy input image')
+    parser.add_argument('-o', '--output', default='dehazed.png', help='output path')
+    parser.add_argument('--resume', default='', type=str, metavar='PATH',
+                        help='checkpoint saved by save_checkpoint, slim.py or quantize.py')
+    parser.add_argument('-b', '--batch-size', default=64, type=int, help='tiles per forward')
+    parser.add_argument('--overlap', default=16, type=int, help='tile overlap in pixels')
+    parser.add_argument('--window', default='hann', choices=['hann', 'linear', 'none'],
+                        help='blend window for overlapping tiles')
+    args = parser.parse_args()
+
+    from PIL import Image
+    import torchvision.transforms.functional as TF
+    # dehaze imports this module
+    from dehaze import load_model
+
+    model = load_model(args.resume)
+    tiler = TiledDehazer(model, overlap=args.overlap, batch_size=args.batch_size, window=args.window)
+
+    image = TF.to_tensor(Image.open(args.image).convert('RGB')) * 2 - 1
+    out = tiler(image)
+    TF.to_pil_image((out * 0.5 + 0.5).clamp(0, 1)).save(args.output)
+    print("{} tiles in {:.2f}s, {:.1f} tiles/sec".format(
+        tiler.stats.tiles, tiler.stats.seconds, tiler.stats.tiles_per_sec))
+
+
+if __name__ == '__main__':
+    main()
@@ -22,17 +22,24 @@ import torch.utils.data.distributed
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 from torch.utils.tensorboard import SummaryWriter
-from PIL import Image
-import torchvision
-import torch.utils.data as DT
 #import torchvision.models as models
 from TD_multi import TD_base
+from haze_data import PairedHazeDataset, PairedCropSampler, collate_crops, make_loader
+from haze_shard import ShardDataset
 
 parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
 parser.add_argument('-d','--data', metavar='DIR', default='./data',
-                    help='path to dataset')
+                    help='path to dataset, with hazy images in input/ and references in ref/, '
+                         'or a shard packed by haze_shard.py')
 parser.add_argument('--eval-data', metavar='DIR', default='./data',
                     help='path to eval dataset')
+parser.add_argument('--crop-size', default=48, type=int, metavar='N',
+                    help='size of the random paired training crops, 0 for whole images (default: 48)')
+parser.add_argument('--crops-per-image', default=1, type=int, metavar='N',
+                    help='aligned, flipped/rotated crops taken from each decoded pair, '
+                         'batch size stays in samples (default: 1)')
+parser.add_argument('--prefetch', default=2, type=int, metavar='N',
+                    help='batches prefetched by each data loading worker (default: 2)')
 parser.add_argument('-s','--save-path', metavar='DIR', default='./ckpt',
                     help='path to save checkpoints')
 parser.add_argument('-j', '--workers', default=8, type=int, metavar='N',
@@ -86,6 +93,8 @@ parser.add_argument('--seed', default=None, type=int,
                     help='seed for initializing training. ')
 parser.add_argument('--gpu', default=None, type=int,
                     help='GPU id to use.')
+parser.add_argument('--device', default=None, type=str,
+                    help='device to train on, e.g. cpu or cuda (default: cuda if available)')
 parser.add_argument('--multiprocessing-distributed', action='store_true',
                     help='Use multi-processing distributed training to launch '
                          'N processes per node, which has N GPUs. This is the '
@@ -177,6 +186,12 @@ class PSNR:
 
 task_map = {"denoise30": 0, "denoise50": 1, "SRx2": 2, "SRx3": 3, "SRx4": 4, "dehaze": 5}
 
+
+def unwrap_model(model):
+    """The bare model inside a DataParallel/DistributedDataParallel wrapper, if any"""
+    return getattr(model, "module", model)
+
+
 def train(train_loader, model, criterion, optimizer, epoch, args, scaler=None):
     # train for one epoch
     epoch_step = 0
@@ -203,7 +218,7 @@ def train(train_loader, model, criterion, optimizer, epoch, args, scaler=None):
         # set random task
         task_id = 5
         input = input_group
-        model.module.set_task(task_id)
+        unwrap_model(model).set_task(task_id)
 
         # print(f"Iter {i}, task_id: {task_id}")
         # for m in model.module.modules():
@@ -219,11 +234,9 @@ def train(train_loader, model, criterion, optimizer, epoch, args, scaler=None):
         # measure data loading time
         data_time.update(time.time() - end)
 
-        if args.gpu is not None:
-            input = input.cuda(args.gpu, non_blocking=True)
-            target = target.cuda(args.gpu, non_blocking=True)
+        input = input.to(args.device, non_blocking=args.non_blocking)
+        target = target.to(args.device, non_blocking=args.non_blocking)
 
-        target = target.cuda()
         if scaler is None:
             # compute output
             output = model(input)
@@ -296,11 +309,9 @@ def validate(val_loader, model, criterion, args):
         for i, (input_group, target) in enumerate(val_loader):
             task_id = 5
             input = input_group
-            model.module.set_task(task_id)
-            if args.gpu is not None:
-                input = input.cuda(args.gpu, non_blocking=True)
-                target = target.cuda(args.gpu, non_blocking=True)
-            target = target.cuda()
+            unwrap_model(model).set_task(task_id)
+            input = input.to(args.device, non_blocking=args.non_blocking)
+            target = target.to(args.device, non_blocking=args.non_blocking)
             # compute output
             output = model(input)
             loss = criterion(output, target)
@@ -332,108 +343,20 @@ def validate(val_loader, model, criterion, args):
 
     return psnr_out.avg
 
-loader = torchvision.transforms.Compose([
-	transforms.ToTensor(),
-	# transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-	# transforms.Normalize(mean=[0.0, 0.0, 0.0], std=[255, 255, 255]),
-])
-def image_data():
-    enc_inputs, dec_inputs, dec_outputs = [], [], []
-    # enc_inputs_o, dec_inputs_o, dec_outputs_o = [], [], []
-    path_haze = 'E:\PyFile/data_ipt2_1/input/'
-    path_ori = 'E:\PyFile/data_ipt2_1/ref/'
-    dirs_haze = os.listdir(path_haze)
-    dirs_ori = os.listdir(path_ori)
-    for file in dirs_haze:
-        haze_image = Image.open('E:\PyFile\\data_ipt2_1\\input\\' + file)
-        # print(haze_image)
-        # np_haze_image = np.array(haze_image)
-        # enc_input_o = np_haze_image.reshape(-1)
-        # enc_input = enc_input_o
-        haze_image = loader(haze_image)
-
-        enc_inputs.append(haze_image)
-
-    for file in dirs_ori:
-        gt_ato_map = Image.open('E:\PyFile\\data_ipt2_1\\ref\\' + file)
-        # np_gt_ato_map = np.array(gt_ato_map)
-        # dec_output_o = np_gt_ato_map.reshape(-1)
-        # dec_input = dec_output = dec_output_o
-        gt_ato_map = loader(gt_ato_map)
-
-        dec_inputs.append(gt_ato_map)
-        # dec_outputs.append(dec_output)
-
-    return enc_inputs, dec_inputs
-
-haze_images, ori_images = image_data()
-
-def image_data_test():
-    enc_inputs, dec_inputs, dec_outputs = [], [], []
-    # enc_inputs_o, dec_inputs_o, dec_outputs_o = [], [], []
-    path_haze = 'E:\PyFile/data_ipt_2/input/'
-    path_ori = 'E:\PyFile/data_ipt_2/ref/'
-    dirs_haze = os.listdir(path_haze)
-    dirs_ori = os.listdir(path_ori)
-    for file in dirs_haze:
-        haze_image = Image.open('E:\PyFile\\data_ipt_2\\input\\' + file)
-        # print(haze_image)
-        # np_haze_image = np.array(haze_image)
-        # enc_input_o = np_haze_image.reshape(-1)
-        # enc_input = enc_input_o
-        haze_image = loader(haze_image)
-
-        enc_inputs.append(haze_image)
-
-    for file in dirs_ori:
-        gt_ato_map = Image.open('E:\PyFile\\data_ipt_2\\ref\\' + file)
-        # np_gt_ato_map = np.array(gt_ato_map)
-        # dec_output_o = np_gt_ato_map.reshape(-1)
-        # dec_input = dec_output = dec_output_o
-        gt_ato_map = loader(gt_ato_map)
-
-        dec_inputs.append(gt_ato_map)
-        # dec_outputs.append(dec_output)
-
-    return enc_inputs, dec_inputs
-
-haze_images_test, ori_images_test = image_data_test()
-
-
-
-######################################
-class MyDataSet(DT.Dataset):
-    def __init__(self, haze_images, ori_images):
-        super(MyDataSet, self).__init__()
-        self.haze_images = haze_images
-        self.ori_images = ori_images
-
-
-    def __len__(self):
-        return len(self.haze_images)
-
-    def __getitem__(self, idx):
-        return self.haze_images[idx], self.ori_images[idx]
-
-class MyDataSet_test(DT.Dataset):
-    def __init__(self, haze_images_test, ori_images_test):
-        super(MyDataSet_test, self).__init__()
-        self.haze_images_test = haze_images_test
-        self.ori_images_test = ori_images_test
-
-
-    def __len__(self):
-        return len(self.haze_images_test)
-
-    def __getitem__(self, idx):
-        return self.haze_images_test[idx], self.ori_images_test[idx]
-
-
 def main_worker(gpu, ngpus_per_node, args):
-    args.gpu = gpu
+    if args.device is None:
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    args.device = torch.device(args.device)
+    args.gpu = gpu if args.device.type == 'cuda' else None
+    if args.gpu is not None:
+        args.device = torch.device('cuda', args.gpu)
+        torch.cuda.set_device(args.device)
+    # pinned host memory and asynchronous copies only exist for CUDA
+    args.non_blocking = args.device.type == 'cuda'
 
     if args.gpu is not None:
         print("Use GPU: {} for training".format(args.gpu))
+    print("Use device: {}".format(args.device))
 
     if args.distributed:
         if args.dist_url == "env://" and args.rank == -1:
@@ -445,8 +368,8 @@ def main_worker(gpu, ngpus_per_node, args):
         dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
                                 world_size=args.world_size, rank=args.rank)
 
-    print("=> creating model '{}'".format("ipt_base"))
-    model = ipt_base().cuda()
+    print("=> creating model '{}'".format("TD_base"))
+    model = TD_base().to(args.device)
 
     # define loss function (criterion) and optimizer
 
@@ -462,7 +385,7 @@ def main_worker(gpu, ngpus_per_node, args):
     if args.resume:
         if os.path.isfile(args.resume):
             print("=> loading checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume)
+            checkpoint = torch.load(args.resume, map_location='cpu')
             if not args.reset_epoch:
                 args.start_epoch = checkpoint['epoch']
             # args.start_epoch = 10
@@ -480,24 +403,18 @@ def main_worker(gpu, ngpus_per_node, args):
         # should always set the single device scope, otherwise,
         # DistributedDataParallel will use all available devices.
         if args.gpu is not None:
-            torch.cuda.set_device(args.gpu)
-            model.cuda(args.gpu)
             # When using a single GPU per process and per
             # DistributedDataParallel, we need to divide the batch size
             # ourselves based on the total number of GPUs we have
             args.batch_size = int(args.batch_size / ngpus_per_node)
             model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
         else:
-            model.cuda()
             # DistributedDataParallel will divide and allocate batch_size to all
             # available GPUs if device_ids are not set
             model = torch.nn.parallel.DistributedDataParallel(model)
-    elif args.gpu is not None:
-        torch.cuda.set_device(args.gpu)
-        model = model.cuda(args.gpu)
-    else:
+    elif args.gpu is None and args.device.type == 'cuda' and torch.cuda.device_count() > 1:
         # DataParallel will divide and allocate batch_size to all available GPUs
-        model = torch.nn.DataParallel(model).cuda()
+        model = torch.nn.DataParallel(model)
     input_size = 48
 
     # Data loading code
@@ -508,16 +425,28 @@ def main_worker(gpu, ngpus_per_node, args):
     if args.eval:
         # val_dataset = ImageProcessDataset(args.eval_data, transform=trans)
         # val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=16)
-        # val_loader = DT.DataLoader(MyDataSet_test(haze_images_test, ori_images_test), batch_size=args.batch_size, shuffle=True, num_workers=16)
-        val_loader = DT.DataLoader(MyDataSet_test(haze_images_test, ori_images_test), batch_size=args.batch_size)
-        # raise RuntimeError("evaluate dataloader not implemented")
+        val_dataset = PairedHazeDataset(args.eval_data)
+        val_loader = make_loader(val_dataset, args.batch_size, workers=args.workers, prefetch=args.prefetch,
+                                 pin_memory=args.non_blocking)
         validate(val_loader, model, criterion, args)
         return
 
     # train_dataset = ImageProcessDataset(args.data, transform=trans)
     # train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=16)
-    # train_loader = DT.DataLoader(MyDataSet(haze_images, ori_images), batch_size=args.batch_size, shuffle=True, num_workers=16)
-    train_loader = DT.DataLoader(MyDataSet(haze_images, ori_images), batch_size=args.batch_size)
+    # with several crops per image, decode whole pairs and cut the crops in the sampler
+    crop_size = args.crop_size if args.crops_per_image == 1 else None
+    if os.path.isfile(args.data):
+        train_dataset = ShardDataset(args.data, crop_size=crop_size)
+    else:
+        train_dataset = PairedHazeDataset(args.data, crop_size=crop_size)
+    if args.crops_per_image > 1:
+        train_dataset = PairedCropSampler(train_dataset, args.crops_per_image, args.crop_size)
+        train_loader = make_loader(train_dataset, max(args.batch_size // args.crops_per_image, 1),
+                                   workers=args.workers, prefetch=args.prefetch, shuffle=True,
+                                   collate_fn=collate_crops, pin_memory=args.non_blocking)
+    else:
+        train_loader = make_loader(train_dataset, args.batch_size, workers=args.workers, prefetch=args.prefetch,
+                                   shuffle=True, pin_memory=args.non_blocking)
 
     args.epoch_size = len(train_loader)
     print(f"Each epoch contains {args.epoch_size} iterations")
@@ -547,7 +476,7 @@ def main_worker(gpu, ngpus_per_node, args):
 
         if not args.multiprocessing_distributed or (args.multiprocessing_distributed
                                                     and args.rank % ngpus_per_node == 0):
-            model_to_save = getattr(model, "module", model)
+            model_to_save = unwrap_model(model)
             save_checkpoint({
                 'epoch': epoch + 1,
                 'state_dict': model_to_save.state_dict(),